@@ -20,12 +20,15 @@ import tornado.web
 import tornado.ioloop
 import tornado.httpserver
 import tornado.options
-from pymongo.errors import DuplicateKeyError
 
 from spiders.business.utils import db_third_party as db
-from spiders.business.utils import COL_REQUESTS, COL_CONFIGS, COL_CHANNELS
+from spiders.business.utils import COL_CONFIGS, COL_CHANNELS, COL_REQUESTS
 from spiders.business.utils import redis
+from spiders.business.utils import insert_requests, seen_requests, CHECK_RAW_UNIQUE
+from spiders.business.taskqueue import queue
 from spiders.models import ListFields
+from spiders.resource import set_mongodb_role
+from spiders.utilities import canonicalize_url
 
 __author__ = "lixianyang"
 __email__ = "705834854@qq.com"
@@ -95,20 +98,26 @@ class BaseHandler(RequestHandler):
         return doc
 
     @classmethod
-    def already_exist(cls, url):
-        n = db[COL_REQUESTS].count({"unique": url})
-        return True if n > 0 else False
+    def already_exist(cls, unique, url=None):
+        """ 不在 seen_requests 中的 unique 由 COL_REQUESTS 的 unique 索引去重, 命中时查询确认(可能误判)
+
+        CHECK_RAW_UNIQUE 时同时检查以原始 url 为 unique 插入过的文档
+        """
+        if CHECK_RAW_UNIQUE and url and url != unique:
+            if db[COL_REQUESTS].find_one({"unique": url}, {"_id": 1}) is not None:
+                return True
+        if unique not in seen_requests:
+            return False
+        return db[COL_REQUESTS].find_one({"unique": unique}, {"_id": 1}) is not None
 
     @staticmethod
     def store_request(doc):
         try:
-            r = db[COL_REQUESTS].insert_one(doc)  # fixme: 插入失败
-        except DuplicateKeyError:
-            pass
+            ids = insert_requests([doc])
         except Exception as e:
             logging.error(e.message, exc_info=True)
         else:
-            return str(r.inserted_id)
+            return ids[0] if ids else None
         return None
 
     def post(self, *args, **kwargs):
@@ -131,7 +140,8 @@ class BaseHandler(RequestHandler):
             logging.warning(message)
             self.write({"message": message})
             return
-        if self.already_exist(url):
+        unique = canonicalize_url(url)
+        if self.already_exist(unique, url):
             message = "Already exist"
             logging.info(message)
             self.write(message)
@@ -147,13 +157,13 @@ class BaseHandler(RequestHandler):
         doc = self.g_request()
         doc["list_fields"] = fields.to_dict()
         doc["pages"] = [{"url": fields.url, "html": ""}]
-        doc["unique"] = fields.url
+        doc["unique"] = unique
         _id = self.store_request(doc)
         if _id:
             message = "Store success %s" % _id
             logging.info(message)
             self.write({"message": message})
-            redis.sadd(self.get_queue_name(), _id)
+            queue.push(self.get_queue_name(), _id)
         else:
             message = "Store error"
             logging.warning(message)
@@ -237,7 +247,9 @@ class WeiBoHandler(RequestHandler):
         """
         item = self.get_body_argument("news", None)
         item = json.loads(item)
-        if db["weibo"].count({"id": item["status"]["id"]}) > 0:
+        status_id = item["status"]["id"]
+        # weibo 表没有唯一索引, 由 id 索引查询确认是否已存储
+        if db["weibo"].count({"id": status_id}, limit=1) > 0:
             message = "Already exists"
             self.write({"message": message})
         else:
@@ -412,6 +424,7 @@ if __name__ == "__main__":
 
     name = sys.argv[1]
     config_logging(name)
+    set_mongodb_role("app")
     if name == "weibo":
         from spiders.business.app import weibo
 
@@ -1,16 +1,33 @@
 # coding: utf-8
 
-from bson import ObjectId
+import argparse
+from collections import defaultdict
+import errno
 import logging
-from random import randint, shuffle
+import os
+from random import shuffle
 import signal
+import socket
 import sys
-from time import sleep
+from threading import Thread, current_thread
+from time import time, sleep
+
+from oss2.exceptions import RequestError as OssRequestError, ServerError as OssServerError
+from pymongo.errors import AutoReconnect
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+from requests import RequestException
+from tornado.httpclient import HTTPError
+from tornado.ioloop import IOLoop
 
 from spiders.business.consts import FORM_NEWS, FORM_JOKE, FORM_VIDEO, FORM_ATLAS
+from spiders.business.utils import configs, channels, get_config_channel
 from spiders.business.utils import db_third_party as db
-from spiders.business.utils import COL_CONFIGS, COL_CHANNELS
 from spiders.business.utils import redis
+from spiders.business import revisit
+from spiders.business.indexes import ensure_indexes
+from spiders.business.sitelimits import install_limiter
+from spiders.business.taskqueue import queue, priority_lane, LEASE_TIMEOUT
 from spiders.business.tasks import run_list_task
 from spiders.business.tasks import run_download_task
 from spiders.business.tasks import run_detail_task
@@ -18,9 +35,14 @@ from spiders.business.tasks import run_clean_filter_task
 from spiders.business.tasks import run_resource_task
 from spiders.business.tasks import run_prepare_task
 from spiders.business.tasks import run_store_task
+from spiders.business.tasks import run_pipeline_task
 from spiders.business.tasks import run_video_task
 from spiders.business.tasks import run_joke_task
-from spiders.error import NotSupportError, MissFieldError, Error
+from spiders.error import NotSupportError, MissFieldError, ImageError, HostUnavailableError
+from spiders.resource import mongodb_pool_stats, set_mongodb_role
+from spiders.settings import MONGODB_POOL_OPTIONS, REDIS_MAX_CONNECTIONS
+from spiders.settings import HTTP_MAX_CLIENTS, HTTP_MAX_PER_HOST
+from spiders.utilities import http
 
 
 KEY_ALL_TASK = "v1:spider:schedule:all:id"
@@ -31,6 +53,7 @@ KEY_CLEAN_TASK = "v1:spider:task:clean:id"
 KEY_RESOURCE_TASK = "v1:spider:task:resource:id"
 KEY_PREPARE_TASK = "v1:spider:task:prepare:id"
 KEY_STORE_TASK = "v1:spider:task:store:id"
+KEY_PIPELINE_TASK = "v1:spider:task:pipeline:id"  # 合并执行下载之后的所有步骤
 
 KEY_WEIXIN_TASK = "v1:spider:task:special:weixin:id"
 KEY_BAIDU_TASK = "v1:spider:task:special:baidu:id"
@@ -38,6 +61,10 @@ KEY_HAOWAI_TASK = "v1:spider:task:special:haowai:id"
 KEY_JOKE_TASK = "v1:spider:task:joke:id"
 KEY_VIDEO_TASK = "v1:spider:task:video:id"
 
+# 任务中的限速, 去重, 缓存等也会访问 redis, 连接错误和超时(包括连接池等待超时)同样稍后重试
+TRANSIENT_ERRORS = (ImageError, RequestException, AutoReconnect, OssRequestError,
+                    socket.error, HostUnavailableError, RedisConnectionError, RedisTimeoutError)
+
 
 def re_distribute_task(_id):
     SITE_KEY_MAPPING = {
@@ -49,16 +76,17 @@ def re_distribute_task(_id):
         FORM_JOKE: KEY_JOKE_TASK,
         FORM_VIDEO: KEY_VIDEO_TASK,
     }
-    config = db[COL_CONFIGS].find_one({"_id": ObjectId(_id)})
-    channel = db[COL_CHANNELS].find_one({"_id": ObjectId(config["channel"])})
+    if not revisit.is_due(_id):  # 根据最近的产出调整了抓取间隔, 还未到下次抓取时间
+        return
+    config, channel = get_config_channel(_id)
     form = channel["form"]
     site_id = str(channel["site"])
     if not channel["category1"]:
         return
-    if site_id in SITE_KEY_MAPPING:
+    if site_id in SITE_KEY_MAPPING:  # 特殊爬虫由外部程序消费, 仍使用 set
         redis.sadd(SITE_KEY_MAPPING[site_id], _id)
-    elif form in FORM_KEY_MAPPING:
-        redis.sadd(FORM_KEY_MAPPING[form], _id)
+    elif form in FORM_KEY_MAPPING:  # 频道优先级决定后续各步骤的队列优先级
+        queue.push(FORM_KEY_MAPPING[form], _id, lane=priority_lane(channel.get("priority")))
     else:
         raise ValueError("Not support form: %s, id: %s" % (form, _id))
 
@@ -79,31 +107,69 @@ SHORT_TIME_MAPPING = {
     KEY_PREPARE_TASK: (run_prepare_task, KEY_STORE_TASK),
     KEY_STORE_TASK: (run_store_task, None)
 }
+PIPELINE_TIME_MAPPING = {
+    KEY_PIPELINE_TASK: (run_pipeline_task, None),
+}
+
+
+def fused_mapping(mapping):
+    """ 将进入详情页解析和清洗过滤的任务改为进入 KEY_PIPELINE_TASK, 由 pipeline 服务在同一进程内完成 """
+    fused = dict()
+    for key, (runner, next_key) in mapping.items():
+        if next_key in (KEY_DETAIL_TASK, KEY_CLEAN_TASK):
+            next_key = KEY_PIPELINE_TASK
+        fused[key] = (runner, next_key)
+    return fused
 
 
-def service(mapping):
+def is_transient_error(e):
+    """ 判断是否是临时性错误(网络超时, 服务端错误, 资源下载上传失败等), 稍后重试可能成功 """
+    if isinstance(e, HTTPError):
+        return e.code == 599 or e.code >= 500
+    if isinstance(e, OssServerError):
+        return e.status >= 500
+    return isinstance(e, TRANSIENT_ERRORS)
+
+
+def service(mapping, concurrency=1, batch=1, lease=LEASE_TIMEOUT):
 
     should_be_kill = list()
+    maintained = [0]
 
     def handle_kill_signals(sig, frame):
         if not should_be_kill:
             should_be_kill.append(sig)
 
-    def spop(keys):
-        shuffle(keys)
-        while 1:
+    def maintain(keys):
+        """ 每 30 秒执行一次的维护操作, 出错时只记录日志, 下一次再执行 """
+        maintained[0] = time()
+        try:
+            configs.refresh()  # 重新加载修改过的 config, channel
+            channels.refresh()
+            logging.info("Mongodb pool stats: %s" % mongodb_pool_stats(reset=True))
+            unavailable = http.health.stats()
+            if unavailable:
+                logging.warning("Unavailable hosts: %s" % unavailable)
             for key in keys:
-                if should_be_kill:
-                    sys.exit(0)
-                _id = redis.spop(key)
-                if _id:
-                    return key, _id
-            sleep(randint(3, 8))
+                queue.reap(key)  # 处理进程异常退出时未 ack 的任务
+                queue.promote(key)  # 到达重试时间的任务
+                queue.migrate(key)  # 外部程序可能仍向旧的 set 写入任务, 定期转移
+        except Exception as e:
+            logging.error("Maintain error: %s" % e, exc_info=True)
 
-    signal.signal(signal.SIGTERM, handle_kill_signals)
-    signal.signal(signal.SIGINT, handle_kill_signals)
-    while 1:
-        key, _id = spop(keys=mapping.keys())
+    def pop(keys):
+        while 1:
+            if should_be_kill:
+                return None, None, []
+            if time() - maintained[0] > 30:
+                maintain(keys)
+            shuffle(keys)
+            key, lane, ids = queue.pop_many(keys, batch, lease=lease)
+            if ids:
+                return key, lane, ids
+
+    def execute(key, _id, pushes):
+        """ 执行任务, 返回 False 表示已放入重试队列, 不需要 ack """
         logging.info("From [%s] get [%s]" % (key, _id))
         runner, next_key = mapping[key]
         try:
@@ -112,21 +178,141 @@ def service(mapping):
             logging.error(str(e.message) + "$id:" + _id)  # Todo record not support domain
         except MissFieldError as e:
             logging.warning(str(e.message) + "$id:" + _id)
-        except Error as e:
-            logging.error(str(e.message) + "$id:" + _id, exc_info=True)
         except Exception as e:
             logging.error(str(e.message) + "$id:" + _id, exc_info=True)
+            if is_transient_error(e):
+                queue.retry(key, _id, e)
+                return False
         else:
             if not next_key:
-                continue
+                return True
             if not id:
-                continue
+                return True
             if isinstance(id, list):
-                redis.sadd(next_key, *id)
+                pushes[next_key].extend(id)
             elif id:
-                redis.sadd(next_key, id)
+                pushes[next_key].append(id)
             else:
                 pass
+        return True
+
+    def work():
+        keys = list(mapping.keys())
+        while 1:
+            try:
+                key, lane, ids = pop(keys=keys)
+                if key is None:  # 收到退出信号, 已取出的任务已经处理完毕
+                    return
+                pushes = defaultdict(list)
+                with queue.keep_alive(key, ids, lease):  # 任务耗时超过租约时不会被 reap 重复执行
+                    acks = [_id for _id in ids if execute(key, _id, pushes)]
+                # 一个批次的结果通过一次 pipeline 进入同一优先级的下一步队列, 同时 ack 本批次的 id
+                queue.push_many(pushes, acks={key: acks}, lane=lane)
+            except Exception as e:  # redis, mongodb 连接错误等, 未 ack 的任务在租约过期后重新入队
+                logging.error("Worker error: %s" % e, exc_info=True)
+                sleep(1)
+
+    def thread_work():
+        IOLoop().make_current()  # multidownload 需要每个线程独立的 IOLoop
+        try:
+            work()
+        except BaseException:
+            logging.critical("Worker thread died", exc_info=True)
+            raise
+        finally:
+            if not should_be_kill:
+                died.append(current_thread().name)
+
+    signal.signal(signal.SIGTERM, handle_kill_signals)
+    signal.signal(signal.SIGINT, handle_kill_signals)
+    ensure_indexes(db)  # 已存在的索引不受影响
+    logging.info("Warm %s configs, %s channels" % (configs.warm(), channels.warm()))
+    if concurrency <= 1:
+        work()
+        sys.exit(0)
+    died = list()  # 没有收到退出信号就结束的线程
+    workers = list()
+    for i in range(concurrency):
+        worker = Thread(target=thread_work, name="worker-%s" % i)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    while any(worker.is_alive() for worker in workers):
+        for worker in workers:
+            worker.join(1)  # 带超时的 join, 主线程才能及时响应信号
+        if died and not should_be_kill:  # 有线程异常结束, 其余线程处理完当前任务后退出, 由 supervise 重启
+            should_be_kill.append(None)
+    if died:
+        logging.critical("Workers %s died without shutdown signal, exit" % died)
+        sys.exit(1)
+    logging.info("All %s workers drained, exit" % concurrency)
+    sys.exit(0)
+
+
+def supervise(target, workers, suffix=""):
+    """ 预先 fork workers 个子进程执行 target, 子进程异常退出时重新 fork
+
+    模块导入和解析配置的加载只在父进程进行一次, 子进程通过 copy-on-write 共享。
+    父进程收到 SIGTERM/SIGINT 后转发给所有子进程, 等待它们处理完当前任务后退出。
+
+    :param target: 子进程中执行的函数
+    :type target: callable
+    :param workers: 子进程数量
+    :type workers: int
+    :param suffix: 日志文件名后缀, 每个子进程写入独立的日志文件
+    :type suffix: str
+    """
+    children = dict()  # pid -> 子进程序号
+    should_be_kill = list()
+
+    def handle_kill_signals(sig, frame):
+        if not should_be_kill:
+            should_be_kill.append(sig)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def spawn(i):
+        pid = os.fork()
+        if pid:
+            children[pid] = i
+            return
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            logging.getLogger().handlers = list()
+            config_logging("%s-%s" % (suffix, i))  # 多个进程轮转同一个日志文件会互相覆盖
+            target()
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException as e:
+            logging.error("Worker %s crashed: %s" % (i, e), exc_info=True)
+        finally:
+            os._exit(code)  # 不能回到父进程的循环中
+
+    signal.signal(signal.SIGTERM, handle_kill_signals)
+    signal.signal(signal.SIGINT, handle_kill_signals)
+    for i in range(workers):
+        spawn(i)
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:  # 被信号中断
+                continue
+            raise
+        i = children.pop(pid, None)
+        if i is None or should_be_kill:
+            continue
+        logging.error("Worker %s (pid %s) exited with status %s, restart" % (i, pid, status))
+        sleep(1)  # 避免启动即崩溃时反复 fork
+        spawn(i)
+    logging.info("All %s worker processes exited" % workers)
+    sys.exit(0)
 
 
 def config_logging(suffix=""):
@@ -143,14 +329,52 @@ def config_logging(suffix=""):
     logging.getLogger().setLevel(level=logging.INFO)
 
 
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="spider pipeline service")
+    parser.add_argument("tier", type=str.lower,
+                        choices=["long", "middle", "short", "pipeline"],
+                        help="long, middle, short time tasks or fused pipeline tasks")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes forked by this process")
+    parser.add_argument("-c", "--concurrency", type=int, default=1,
+                        help="number of tasks run at once in this process")
+    parser.add_argument("-b", "--batch", type=int, default=1,
+                        help="number of ids popped from redis at once by each worker")
+    parser.add_argument("-l", "--lease", type=int, default=LEASE_TIMEOUT,
+                        help="seconds before an unacknowledged task is re-enqueued")
+    parser.add_argument("-f", "--fused", action="store_true",
+                        help="send downloaded requests to the fused pipeline tier")
+    parser.add_argument("--max-clients", type=int, default=HTTP_MAX_CLIENTS,
+                        help="number of concurrent http requests per worker thread")
+    parser.add_argument("--max-per-host", type=int, default=HTTP_MAX_PER_HOST,
+                        help="number of concurrent http connections to one host")
+    parser.add_argument("--no-limit", action="store_true",
+                        help="do not wait on the per-host rate limiter shared through redis")
+    return parser.parse_args(args)
+
+
 if __name__ == "__main__":
-    t = sys.argv[1].lower()
-    config_logging(t)
-    if t == "long":
-        service(LONG_TIME_MAPPING)
-    elif t == "short":
-        service(SHORT_TIME_MAPPING)
-    elif t == "middle":
-        service(MIDDLE_TIME_MAPPING)
+    options = parse_args()
+    # 每个线程都可能同时占用一个 redis 连接, 连接池满时其他请求等待(BlockingConnectionPool)
+    if options.concurrency > REDIS_MAX_CONNECTIONS:
+        raise ValueError("Concurrency should not exceed %s" % REDIS_MAX_CONNECTIONS)
+    config_logging(options.tier)
+    # 每个线程同时最多使用一个连接
+    pool_size = max(MONGODB_POOL_OPTIONS["worker"]["maxPoolSize"], options.concurrency)
+    set_mongodb_role("worker", maxPoolSize=pool_size)
+    http.configure(options.max_clients, options.max_per_host)
+    if not options.no_limit:
+        install_limiter()
+    if options.tier == "long":
+        mapping = LONG_TIME_MAPPING
+    elif options.tier == "short":
+        mapping = SHORT_TIME_MAPPING
+    elif options.tier == "middle":
+        mapping = fused_mapping(MIDDLE_TIME_MAPPING) if options.fused else MIDDLE_TIME_MAPPING
+    else:
+        mapping = PIPELINE_TIME_MAPPING
+    if options.workers > 1:
+        supervise(lambda: service(mapping, options.concurrency, options.batch, options.lease),
+                  options.workers, options.tier)
     else:
-        raise ValueError("Only support long, middle, short command params")
+        service(mapping, options.concurrency, options.batch, options.lease)
@@ -2,13 +2,13 @@
 import time
 from spiders.utilities import http, format_datetime_string, clean_date_time
 from spiders.parsers.feed import FeedParser
-from spiders.business.utils import redis
+from spiders.business.taskqueue import queue
 from spiders.models import NewsFields, ListFields, ForeignFields, AtlasFields
 from spiders.utilities import get_string_md5, utc_datetime_now
-from pymongo.errors import DuplicateKeyError
+from spiders.utilities import canonicalize_url
 from urllib import quote
 from pymongo import MongoClient
-from spiders.business.utils import db_third_party as db
+from spiders.business.utils import insert_requests
 
 PROCEDURE_LIST_TASK = 0  # 完成列表页解析状态
 
@@ -28,7 +28,7 @@ def general_list(list_page_info):
 
     content = http.download_html(url=list_page_info["url"])
     result = FeedParser(document=content, crawler=list_page_info["crawler"], url=list_page_info["url"])
-    ids = list()
+    docs = list()
     for item in result:
         middle = _request_doc_from_config_channel(list_page_info)
         fields = ListFields()
@@ -43,26 +43,20 @@ def general_list(list_page_info):
             fields.thumbs.append(item["thumb"])
         middle["list_fields"] = fields.to_dict()
         middle["pages"] = [{"url": item["url"], "html": ""}]
-        middle["unique"] = item["url"]  # 以 url 作为唯一性约束,避免重复抓取 TODO: 归一化url
+        middle["unique"] = canonicalize_url(item["url"])  # 以归一化的 url 作为唯一性约束,避免重复抓取
         middle["procedure"] = PROCEDURE_LIST_TASK
-        try:
-            r = db.v1_request.insert_one(middle)  # fixme: 插入失败
-        except DuplicateKeyError:
-            print "DuplicateKeyError"
-        except Exception as e:
-            print e
-        else:
-            print "MONGO Insert Success"
-            ids.append(str(r.inserted_id))
+        docs.append(middle)
+    ids = insert_requests(docs)
+    print "MONGO Insert %s/%s" % (len(ids), len(docs))
 
     next_key = "v1:spider:task:download:id"
     if not ids:
         return
     if isinstance(ids, list):
-        redis.sadd(next_key, *ids)
+        queue.push(next_key, *ids)
         print "REDIS Add Success"
     elif id:
-        redis.sadd(next_key, ids)
+        queue.push(next_key, ids)
         print "REDIS Add Success"
     else:
         print "REDIS Add Faild"
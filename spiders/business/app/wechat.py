@@ -11,8 +11,11 @@ from bson import ObjectId
 
 from spiders.business.utils import db_third_party as db
 from spiders.business.utils import redis
+from spiders.business.taskqueue import queue
 from spiders.business.utils import COL_CHANNELS, COL_CONFIGS, COL_REQUESTS
+from spiders.business.utils import CHECK_RAW_UNIQUE, raw_unique
 from spiders.utilities import utc_datetime_now
+from spiders.utilities import canonicalize_url
 from spiders.models import ListFields
 
 
@@ -129,10 +132,13 @@ def new_wechat_task(sn, debug=False):
         doc["list_fields"]["n_read"] = n_read
         doc["list_fields"]["n_like"] = n_like
     doc["pages"] = [{"url": article["url"], "html": ""}]
-    doc["unique"] = article["url"]
+    doc["unique"] = canonicalize_url(article["url"])
     doc["procedure"] = 0
     if debug:
         return doc
+    raw = raw_unique(doc) if CHECK_RAW_UNIQUE else None
+    if raw and db[COL_REQUESTS].find_one({"unique": raw}, {"_id": 1}) is not None:
+        return None
     try:
         result = db[COL_REQUESTS].insert_one(doc)
     except Exception:
@@ -159,7 +165,7 @@ def main():
         try:
             w_id = new_wechat_task(sn)
             if w_id:
-                redis.sadd(KEY_DOWNLOAD_TASK, w_id)
+                queue.push(KEY_DOWNLOAD_TASK, w_id)
         except Exception as e:
             logging.error(e.message, exc_info=True)
 
@@ -4,14 +4,15 @@ from datetime import datetime
 import logging
 
 from bson import ObjectId
-from pymongo.errors import DuplicateKeyError
 
 from spiders.models import VideoFields
 from spiders.business.utils import db_third_party as db
-from spiders.business.utils import COL_REQUESTS
+from spiders.business.utils import insert_requests
 from spiders.business.utils import redis
+from spiders.business.taskqueue import queue
+from spiders.utilities import canonicalize_url
 
-import requests
+from spiders.utilities.http import get_session
 
 __author__ = "lixianyang"
 __email__ = "705834854@qq.com"
@@ -81,12 +82,12 @@ class WeiBoProcessor(object):
         doc["site"] = "57ac3802da083a1c19957b1b"
         doc["time"] = datetime.utcnow()
         doc["fields"] = video.to_dict()
-        doc["unique"] = video.publish_ori_url
+        doc["unique"] = canonicalize_url(video.publish_ori_url)
         doc["procedure"] = 20000  # 完成详情页解析状态
         _id = cls.store_request(doc)
         if _id:
             logging.info("process weibo video %s" % _id)
-            redis.sadd(KEY_CLEAN_TASK, _id)
+            queue.push(KEY_CLEAN_TASK, _id)
 
     @classmethod
     def process_news(cls, wb):
@@ -95,7 +96,7 @@ class WeiBoProcessor(object):
             return "Miss outer link in blog content"
         short_url = wb["mblogcards"][0]["shortUrl"]
         try:
-            r = requests.get(short_url, timeout=(5, 15))
+            r = get_session().get(short_url, timeout=(5, 15))
         except Exception as e:
             logging.warning(e.message)
             return
@@ -108,24 +109,22 @@ class WeiBoProcessor(object):
         doc["time"] = datetime.utcnow()
         doc["fields"] = dict()
         doc["list_fields"] = {"url": url}
-        doc["unique"] = url
+        doc["unique"] = canonicalize_url(url)
         doc["pages"] = [{"url": url, "html": ""}]
         doc["procedure"] = 0  # 完成列表页解析状态
         _id = cls.store_request(doc)
         if _id:
             logging.info("process weibo news %s" % _id)
-            redis.sadd(KEY_DOWNLOAD_TASK, _id)
+            queue.push(KEY_DOWNLOAD_TASK, _id)
 
     @staticmethod
     def store_request(doc):
         try:
-            r = db[COL_REQUESTS].insert_one(doc)  # fixme: 插入失败
-        except DuplicateKeyError:
-            pass
+            ids = insert_requests([doc])
         except Exception as e:
             logging.error(e.message, exc_info=True)
         else:
-            return str(r.inserted_id)
+            return ids[0] if ids else None
         return None
 
     @classmethod
@@ -148,7 +147,7 @@ class WeiBoProcessor(object):
             url = "http://bdp.deeporiginalx.com/v2/hot/crawler/news"
             data = {"news": [title]}
             try:
-                r = requests.post(url, data=data, timeout=(5, 10))
+                r = get_session().post(url, data=data, timeout=(5, 10))
             except Exception as e:
                 logging.error(e.message)
             else:
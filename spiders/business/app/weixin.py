@@ -9,10 +9,13 @@ from bson import ObjectId
 import xmltodict
 
 from spiders.business.utils import db_third_party as db
-from spiders.business.utils import COL_CHANNELS, COL_CONFIGS, COL_REQUESTS
+from spiders.business.utils import COL_CHANNELS, COL_CONFIGS
+from spiders.business.utils import insert_requests
 from spiders.business.utils import redis
+from spiders.business.taskqueue import queue
 from spiders.models import ListFields
 from spiders.utilities import utc_datetime_now
+from spiders.utilities import canonicalize_url
 
 
 COL_WEIXIN_MESSAGE = "weixin_message"
@@ -97,7 +100,7 @@ def process(message):
         list_fields = item
         document["list_fields"] = list_fields.to_dict()
         document["pages"] = [{"url": list_fields.url, "html": ""}]
-        document["unique"] = list_fields.url
+        document["unique"] = canonicalize_url(list_fields.url)
         document["procedure"] = 0
         documents.append(document)
     return documents
@@ -120,15 +123,13 @@ def main():
             logging.error(e.message, exc_info=True)
             logging.error("error _id: %s" % _id)
         else:
-            for document in documents:
-                try:
-                    result = db[COL_REQUESTS].insert_one(document)
-                except Exception as e:
-                    logging.error(e.message)
-                else:
-                    r_id = str(result.inserted_id)
-                    redis.sadd(KEY_DOWNLOAD_TASK, r_id)
-                    logging.info("process weixin request id: %s" % r_id)
+            try:
+                ids = insert_requests(documents)
+            except Exception as e:
+                logging.error(e.message)
+            else:
+                queue.push(KEY_DOWNLOAD_TASK, *ids)
+                logging.info("process weixin request ids: %s" % ids)
 
 
 if __name__ == "__main__":
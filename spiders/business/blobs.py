@@ -0,0 +1,71 @@
+# coding: utf-8
+
+""" 详情页 HTML 压缩后单独存储在 COL_PAGES 表
+
+COL_PAGES 的 _id 为 HTML(utf-8) 的 sha1, data 为 zlib 压缩后的内容, 相同的页面只存储一次。
+COL_REQUESTS 的 pages 中只保存引用 {"url": url, "blob": sha1}, 需要页面内容时通过 load_pages 读取。
+旧的直接保存 html 的 pages 仍然可以正常读取。页面内容不会过期删除, 引用的内容不存在时 load_pages 抛出异常。
+"""
+
+import hashlib
+import zlib
+
+from bson import Binary
+from pymongo import UpdateOne
+
+from spiders.business.utils import COL_PAGES
+from spiders.business.utils import db_third_party as db
+from spiders.error import PageMissingError
+from spiders.utilities import utc_datetime_now
+
+
+def _encode(html):
+    return html.encode("utf-8") if isinstance(html, unicode) else html
+
+
+def store_pages(pages):
+    """ 通过一次 bulk_write 存储页面内容, 返回只包含引用的 pages
+
+    :param pages: [{"url": url, "html": html}, ...]
+    :type pages: list of dict
+    :return: [{"url": url, "blob": sha1}, ...]
+    :rtype: list of dict
+    """
+    refs = list()
+    operations = dict()
+    now = utc_datetime_now()
+    for page in pages:
+        data = _encode(page["html"] or "")
+        sha1 = hashlib.sha1(data).hexdigest()
+        refs.append({"url": page["url"], "blob": sha1})
+        if sha1 not in operations:
+            document = {"data": Binary(zlib.compress(data)), "size": len(data), "time": now}
+            operations[sha1] = UpdateOne({"_id": sha1}, {"$setOnInsert": document}, upsert=True)
+    if operations:
+        db[COL_PAGES].bulk_write(operations.values(), ordered=False)
+    return refs
+
+
+def load_pages(pages):
+    """ 读取引用对应的页面内容, 解压后写入每个 page 的 html 字段
+
+    :param pages: store_pages 返回的 pages, 或者直接包含 html 的旧 pages
+    :type pages: list of dict
+    :return: pages
+    :rtype: list of dict
+    :raise PageMissingError: 引用的页面内容不存在
+    """
+    hashes = list(set(page["blob"] for page in pages if "blob" in page and "html" not in page))
+    if not hashes:
+        return pages
+    blobs = dict()
+    for document in db[COL_PAGES].find({"_id": {"$in": hashes}}):
+        blobs[document["_id"]] = zlib.decompress(document["data"]).decode("utf-8", "replace")
+    missing = [page["url"] for page in pages
+               if "blob" in page and "html" not in page and page["blob"] not in blobs]
+    if missing:
+        raise PageMissingError("page content missing: %s" % ", ".join(missing))
+    for page in pages:
+        if "blob" in page and "html" not in page:
+            page["html"] = blobs[page["blob"]]
+    return pages
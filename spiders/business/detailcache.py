@@ -0,0 +1,131 @@
+# coding: utf-8
+
+""" 按页面内容缓存详情页解析结果
+
+同一篇文章经常通过不同的频道, 短链接或跳转以不同的 unique 进入 pipeline, 跳转后的 url 和
+页面内容相同时直接使用 redis 中缓存的 DetailParser 结果, 不再重复解析。
+DetailParser 根据 url 选择解析配置并用它补全相对链接, 因此缓存的 key 由页面 url(去掉 fragment)
+和页面 HTML(utf-8) 的 sha1 共同决定。同一篇文章的重复抓取集中在几个小时内, 缓存只保留 CACHE_TTL 秒,
+压缩后超过 MAX_CACHE_SIZE 字节的结果不缓存, 限制与任务队列共用的 redis 的内存。
+
+没有解析配置的详情页域名记录在 KEY_UNSUPPORTED hash 中(域名 -> 次数), 用于决定优先编写哪些解析配置。
+详情页链接可能跳转到其他域名(短链接, 聚合平台的原文链接等), 跳转过的链接域名记录在 KEY_REDIRECTS set 中,
+这些域名的链接只能在下载之后根据跳转后的链接判断是否支持。
+"""
+
+import hashlib
+import json
+import logging
+from urlparse import urlparse
+import zlib
+
+from spiders.business.utils import redis
+from spiders.parsers.detail import DetailParser
+
+KEY_PREFIX = "v1:spider:detail:"
+KEY_UNSUPPORTED = "v1:spider:detail:unsupported"
+KEY_REDIRECTS = "v1:spider:detail:redirects"
+CACHE_TTL = 6 * 3600  # 解析结果缓存秒数
+MAX_CACHE_SIZE = 64 * 1024  # 缓存的单个解析结果(压缩后)最大字节数
+
+
+def page_hash(page):
+    """ 页面内容的 sha1, 由 store_pages 存储的页面直接使用其引用 """
+    if "blob" in page:
+        return page["blob"]
+    html = page["html"] or ""
+    if isinstance(html, unicode):
+        html = html.encode("utf-8")
+    return hashlib.sha1(html).hexdigest()
+
+
+def cache_key(page):
+    """ 解析结果的缓存 key, 由页面 url 和内容决定 """
+    url = page["url"] or ""
+    if isinstance(url, unicode):
+        url = url.encode("utf-8")
+    url = url.split("#", 1)[0]
+    return KEY_PREFIX + hashlib.sha1("%s\n%s" % (url, page_hash(page))).hexdigest()
+
+
+def record_unsupported(url):
+    """ 记录一次不支持的详情页域名 """
+    domain = urlparse(url).hostname
+    if domain:
+        redis.hincrby(KEY_UNSUPPORTED, domain, 1)
+
+
+def record_redirect(url, effective_url):
+    """ 详情页链接跳转到其他域名时记录链接的域名
+
+    :param url: 详情页链接
+    :type url: str
+    :param effective_url: 跳转后的链接
+    :type effective_url: str
+    """
+    host, target = urlparse(url).hostname, urlparse(effective_url).hostname
+    if host and target and host != target:
+        redis.sadd(KEY_REDIRECTS, host)
+
+
+def unsupported_urls(urls):
+    """ 不下载就可以判定为不支持的详情页链接
+
+    没有解析配置, 域名下载到过不支持的详情页(在 KEY_UNSUPPORTED 中)且链接从未跳转到其他域名时判定为不支持,
+    其他没有解析配置的链接可能跳转到支持的域名, 需要下载后判断
+
+    :param urls: 详情页链接
+    :type urls: list of str
+    :rtype: set
+    """
+    candidates = list()
+    for url in urls:
+        host = urlparse(url).hostname
+        if host and not DetailParser.supports(url):
+            candidates.append((url, host))
+    if not candidates:
+        return set()
+    pipe = redis.pipeline(transaction=False)
+    for _, host in candidates:
+        pipe.hexists(KEY_UNSUPPORTED, host)
+        pipe.sismember(KEY_REDIRECTS, host)
+    flags = pipe.execute()
+    return set(url for i, (url, _) in enumerate(candidates) if flags[2 * i] and not flags[2 * i + 1])
+
+
+def unsupported_domains(n=50):
+    """ 不支持的次数最多的 n 个域名
+
+    :return: [(域名, 次数)]
+    :rtype: list
+    """
+    counts = redis.hgetall(KEY_UNSUPPORTED)
+    items = sorted(((domain, int(count)) for domain, count in counts.items()),
+                   key=lambda item: item[1], reverse=True)
+    return items[:n]
+
+
+def parse_detail(page):
+    """ 解析详情页, 相同内容的页面只解析一次
+
+    只缓存支持的域名的解析结果, 新增解析配置后不支持的页面可以立即重新解析
+
+    :param page: {"url": url, "html": html, "blob": sha1}
+    :type page: dict
+    :return: DetailParser 的解析结果
+    :rtype: dict
+    """
+    key = cache_key(page)
+    data = redis.get(key)
+    if data:
+        return json.loads(zlib.decompress(data))
+    result = DetailParser(url=page["url"], document=page["html"])
+    if result["support"]:
+        try:
+            data = zlib.compress(json.dumps(result))
+        except (TypeError, ValueError) as e:
+            logging.warning("Detail result not cacheable %s: %s" % (page["url"], e))
+        else:
+            if len(data) <= MAX_CACHE_SIZE:
+                redis.set(key, data, ex=CACHE_TTL)
+    return result
@@ -0,0 +1,141 @@
+# coding: utf-8
+
+""" thirdparty 数据库需要的索引
+
+检查线上(或本地)数据库的索引与声明是否一致:
+
+    python -m spiders.business.indexes diff [--uri mongodb://127.0.0.1/thirdparty]
+
+创建缺少的索引(后台创建, 已存在的索引不受影响):
+
+    python -m spiders.business.indexes ensure [--uri mongodb://127.0.0.1/thirdparty]
+"""
+
+import argparse
+import logging
+
+from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo.errors import OperationFailure
+
+from spiders.business.utils import COL_REQUESTS, COL_CONFIGS, COL_CHANNELS, COL_ADVERTISEMENT
+from spiders.business.utils import COL_PAGES
+from spiders.business.utils import db_third_party
+
+# 集合名 -> [(索引字段, 索引选项)]
+INDEXES = {
+    COL_REQUESTS: [
+        ([("unique", ASCENDING)], {"unique": True}),  # 列表页插入去重, already_exist
+        ([("channel", ASCENDING)], {}),  # log_analyze 按频道统计
+        ([("procedure", ASCENDING), ("time", DESCENDING)], {}),  # 按状态查看最近的任务
+    ],
+    COL_PAGES: [],  # 页面内容不能过期删除, 旧的 time TTL 索引会显示为 extra, 需要手动 dropIndex
+    COL_CONFIGS: [
+        ([("channel", ASCENDING)], {}),  # 微信公众号查找 config
+        ([("modified", ASCENDING)], {}),  # CachedCollection.refresh
+    ],
+    COL_CHANNELS: [
+        ([("site", ASCENDING)], {}),  # app-service 按站点列出频道
+        ([("name", ASCENDING), ("site", ASCENDING)], {}),  # weixin 按公众号名称查找
+        ([("meta.name", ASCENDING), ("site", ASCENDING)], {}),  # wechat 按公众号查找
+        ([("modified", ASCENDING)], {}),  # CachedCollection.refresh
+    ],
+    COL_ADVERTISEMENT: [  # is_advertisement 的 $or 查询每个分支各使用一个索引
+        ([("url", ASCENDING)], {}),
+        ([("md5", ASCENDING)], {}),
+    ],
+    "weibo": [
+        ([("id", ASCENDING)], {}),
+    ],
+    "wechat_list": [
+        ([("snarray", ASCENDING)], {}),
+    ],
+    "wechat_detail": [
+        ([("meta.sn", ASCENDING)], {}),
+    ],
+    "wechat_metric": [
+        ([("meta.comment_id", ASCENDING)], {}),
+    ],
+}
+OPTIONS = ("unique", "expireAfterSeconds")  # 比较时关注的索引选项
+
+
+def _normalize(keys, options):
+    keys = tuple((field, int(direction) if isinstance(direction, (int, float)) else direction)
+                 for field, direction in keys)
+    options = tuple((k, options[k]) for k in OPTIONS if k in options)
+    return keys, options
+
+
+def diff_indexes(db):
+    """ 比较数据库中的索引与 INDEXES 的声明
+
+    :param db: pymongo Database
+    :return: 集合名 -> (缺少的索引, 选项不一致的索引, 多余的索引)
+    :rtype: dict
+    """
+    result = dict()
+    for name, declared in sorted(INDEXES.items()):
+        existing = dict()
+        for index_name, info in db[name].index_information().items():
+            if index_name == "_id_":
+                continue
+            keys, options = _normalize(info["key"], info)
+            existing[keys] = (index_name, options)
+        missing, conflict = list(), list()
+        for keys, options in declared:
+            keys, options = _normalize(keys, options)
+            if keys not in existing:
+                missing.append((keys, options))
+            elif existing.pop(keys)[1] != options:
+                conflict.append((keys, options))
+        extra = [(k, o) for k, (_, o) in existing.items()]
+        if missing or conflict or extra:
+            result[name] = (missing, conflict, extra)
+    return result
+
+
+def ensure_indexes(db):
+    """ 后台创建 INDEXES 中声明的索引, 已存在的索引不受影响
+
+    已有数据不满足索引要求(如 unique 重复)或选项冲突时只记录错误
+
+    :param db: pymongo Database
+    :return: 创建失败的数量
+    :rtype: int
+    """
+    n = 0
+    for name, declared in sorted(INDEXES.items()):
+        for keys, options in declared:
+            try:
+                db[name].create_index(keys, background=True, **options)
+            except OperationFailure as e:
+                n += 1
+                logging.error("Create index %s on %s error: %s" % (keys, name, e))
+    return n
+
+
+def _format(keys, options):
+    return "%s %s" % (", ".join("%s:%s" % item for item in keys), dict(options) or "")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="thirdparty index management")
+    parser.add_argument("command", choices=["diff", "ensure"])
+    parser.add_argument("--uri", default=None,
+                        help="mongodb uri with database, defaults to the configured thirdparty")
+    options = parser.parse_args(args)
+    db = MongoClient(options.uri).get_default_database() if options.uri else db_third_party
+    if options.command == "ensure":
+        return 1 if ensure_indexes(db) else 0
+    result = diff_indexes(db)
+    for name, (missing, conflict, extra) in sorted(result.items()):
+        print name
+        for label, items in (("missing", missing), ("conflict", conflict), ("extra", extra)):
+            for keys, index_options in items:
+                print "    %-8s %s" % (label, _format(keys, index_options))
+    return 1 if result else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(main())
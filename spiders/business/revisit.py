@@ -0,0 +1,71 @@
+# coding: utf-8
+
+""" 根据列表页抓取到的新资讯数量自适应调整 spider_config 的抓取间隔
+
+- ``KEY_INTERVAL`` hash, config _id 到当前抓取间隔(秒)
+- ``KEY_DUE`` sorted set, config _id 到下次抓取时间
+
+一次抓取中新资讯占比不低于 GROW_RATIO 时间隔减半, 没有新资讯时间隔加倍,
+间隔限制在 [MIN_INTERVAL, MAX_INTERVAL] 之内。没有记录过的 config 总是可以抓取。
+"""
+
+import logging
+import time
+
+from spiders.business.utils import redis
+
+KEY_INTERVAL = "v1:spider:schedule:interval"
+KEY_DUE = "v1:spider:schedule:due"
+MIN_INTERVAL = 300  # 最短抓取间隔(秒)
+MAX_INTERVAL = 6 * 3600  # 最长抓取间隔(秒)
+GROW_RATIO = 0.5  # 新资讯占比不低于该值时缩短间隔
+
+
+def next_interval(interval, n_new, n_total):
+    """ 根据本次抓取的新资讯数量计算下次抓取间隔
+
+    :param interval: 当前抓取间隔(秒)
+    :type interval: int
+    :param n_new: 新插入的资讯数量
+    :type n_new: int
+    :param n_total: 列表页解析出的资讯数量
+    :type n_total: int
+    :rtype: int
+    """
+    if n_new == 0:
+        interval *= 2
+    elif n_new >= n_total * GROW_RATIO:
+        interval /= 2
+    return max(MIN_INTERVAL, min(MAX_INTERVAL, int(interval)))
+
+
+def record_yield(_id, n_new, n_total):
+    """ 记录 config 一次抓取的产出, 更新抓取间隔和下次抓取时间
+
+    :param _id: spider_configs 表 _id
+    :type _id: str
+    :return: 新的抓取间隔(秒)
+    :rtype: int
+    """
+    interval = int(redis.hget(KEY_INTERVAL, _id) or MIN_INTERVAL)
+    interval = next_interval(interval, n_new, n_total)
+    pipe = redis.pipeline(transaction=False)
+    pipe.hset(KEY_INTERVAL, _id, interval)
+    pipe.execute_command("ZADD", KEY_DUE, time.time() + interval, _id)
+    pipe.execute()
+    logging.info("Config %s yield %s/%s, next in %ss" % (_id, n_new, n_total, interval))
+    return interval
+
+
+def is_due(_id):
+    """ config 是否到达下次抓取时间 """
+    due = redis.zscore(KEY_DUE, _id)
+    return due is None or due <= time.time()
+
+
+def reset(_id):
+    """ 清除 config 的抓取间隔, 下次立即抓取(如修改了 config 之后) """
+    pipe = redis.pipeline(transaction=False)
+    pipe.hdel(KEY_INTERVAL, _id)
+    pipe.zrem(KEY_DUE, _id)
+    pipe.execute()
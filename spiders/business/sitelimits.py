@@ -0,0 +1,63 @@
+# coding: utf-8
+
+""" 按域名限制所有抓取机器对同一网站的请求频率和并发数
+
+默认限制见 settings.HTTP_HOST_RATE, HTTP_HOST_BURST, HTTP_HOST_INFLIGHT。
+spider_sites 文档可以通过 limit 字段覆盖默认值, 对 hosts 中的域名及其子域名生效, 例如:
+
+    {"limit": {"hosts": ["sinaimg.cn"], "rate": 5, "burst": 10, "inflight": 8}}
+"""
+
+from threading import Lock
+import time
+
+from spiders.business.utils import db_third_party, redis
+from spiders.settings import HTTP_HOST_RATE, HTTP_HOST_BURST, HTTP_HOST_INFLIGHT
+from spiders.utilities import http
+from spiders.utilities.ratelimit import HostLimiter
+
+COL_SITES = "spider_sites"
+KEY_PREFIX = "v1:spider:limit"
+
+
+class SiteLimits(object):
+    """ spider_sites 中配置的域名限制, 每 refresh_interval 秒重新加载 """
+
+    def __init__(self, refresh_interval=300):
+        self.refresh_interval = refresh_interval
+        self.hosts = dict()  # 域名 -> limit
+        self._loaded = 0
+        self._lock = Lock()
+
+    def _load(self):
+        hosts = dict()
+        query = {"limit": {"$exists": True}}
+        for site in db_third_party[COL_SITES].find(query, projection={"limit": 1}):
+            limit = site["limit"] or dict()
+            for host in limit.get("hosts", list()):
+                hosts[host.lower()] = {k: v for k, v in limit.items() if k != "hosts"}
+        self.hosts = hosts
+        self._loaded = time.time()
+
+    def get(self, host):
+        """ 域名或其上级域名配置的 limit, 没有配置时返回 None """
+        if time.time() - self._loaded > self.refresh_interval:
+            with self._lock:  # 获得锁之后再次检查, 其他线程可能已经加载过
+                if time.time() - self._loaded > self.refresh_interval:
+                    self._load()
+        labels = host.lower().split(".")
+        for i in range(len(labels) - 1):
+            limit = self.hosts.get(".".join(labels[i:]))
+            if limit is not None:
+                return limit
+        return None
+
+
+site_limits = SiteLimits()
+limiter = HostLimiter(redis, KEY_PREFIX, rate=HTTP_HOST_RATE, burst=HTTP_HOST_BURST,
+                      inflight=HTTP_HOST_INFLIGHT, overrides=site_limits.get)
+
+
+def install_limiter():
+    """ 所有通过 spiders.utilities.http 的下载都等待 limiter 的许可 """
+    http.set_limiter(limiter)
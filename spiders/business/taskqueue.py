@@ -0,0 +1,434 @@
+# coding: utf-8
+
+""" 爬虫 pipeline 任务队列
+
+每个任务 key 对应 redis 中的以下结构:
+
+- ``<key>:queue`` ``<key>:queue:high`` ``<key>:queue:low`` list, 按优先级分开排队的 id,
+  高优先级队列总是先出队, 同一队列内先入先出
+- ``<key>:notify`` list, 入队时写入的唤醒信号, 消费者所有队列都为空时通过 BRPOP 阻塞等待,
+  id 始终由脚本在出队的同时记录租约, 不会出现已出队但没有租约的 id
+- ``<key>:pending`` set, 排队中的 id, 用于去重
+- ``<key>:lanes`` hash, 非普通优先级的 id 所在的队列, 重试和租约过期时放回原队列
+- ``<key>:inflight`` sorted set, 已出队正在处理的 id, score 为租约到期时间
+- ``<key>:retry`` sorted set, 等待重试的 id, score 为下次重试时间
+- ``<key>:attempts`` hash, id 已失败的次数
+- ``<key>:dead`` hash, 超过最大重试次数的 id 及其错误信息
+
+id 在出队之前重复入队会被忽略, 与原来直接使用 set 存储任务的去重效果一致。
+出队的 id 处理完成后需要 ack, 进程被杀死等原因导致租约过期的 id 会被 reap 重新入队。
+临时性错误通过 retry 按指数退避重新入队, 超过最大次数后进入 dead。
+"""
+
+import logging
+from threading import Event, Thread
+import time
+
+from spiders.business.utils import redis
+
+QUEUE_SUFFIX = ":queue"
+PENDING_SUFFIX = ":pending"
+NOTIFY_SUFFIX = ":notify"
+NOTIFY_MAX = 1000  # 唤醒信号最多保留的数量
+LANES_SUFFIX = ":lanes"
+INFLIGHT_SUFFIX = ":inflight"
+RETRY_SUFFIX = ":retry"
+ATTEMPTS_SUFFIX = ":attempts"
+DEAD_SUFFIX = ":dead"
+LEASE_TIMEOUT = 600  # 默认每个任务的租约时长(秒)
+RETRY_MAX_ATTEMPTS = 5  # 最多重试次数
+RETRY_BASE_DELAY = 30  # 第一次重试的等待秒数, 之后每次翻倍
+RETRY_MAX_DELAY = 1800  # 重试等待秒数上限
+
+LANE_HIGH = "high"
+LANE_NORMAL = "normal"
+LANE_LOW = "low"
+LANES = (LANE_HIGH, LANE_NORMAL, LANE_LOW)  # 按出队顺序排列
+PRIORITY_HIGH = 1  # spider_channels.priority 不小于该值进入高优先级队列
+PRIORITY_LOW = -1  # spider_channels.priority 不大于该值进入低优先级队列
+
+# KEYS: queue, pending, lanes, notify ARGV: lane index, notify max, ids
+_PUSH_SCRIPT = """
+local n = 0
+local lane = ARGV[1]
+for i = 3, #ARGV do
+    local id = ARGV[i]
+    if redis.call("SADD", KEYS[2], id) == 1 then
+        redis.call("LPUSH", KEYS[1], id)
+        if lane == "2" then
+            redis.call("HDEL", KEYS[3], id)
+        else
+            redis.call("HSET", KEYS[3], id, lane)
+        end
+        redis.call("LPUSH", KEYS[4], "1")
+        n = n + 1
+    end
+end
+if n > 0 then
+    redis.call("LTRIM", KEYS[4], 0, tonumber(ARGV[2]) - 1)
+end
+return n
+"""
+
+# KEYS: queue1, pending1, inflight1, queue2, pending2, inflight2 ... ARGV: count, deadline
+# 从第一个非空队列中最多取出 count 个 id 并记录租约, 返回 {队列序号, ids}
+_POP_SCRIPT = """
+local count = tonumber(ARGV[1])
+for k = 1, #KEYS / 3 do
+    local ids = {}
+    for i = 1, count do
+        local id = redis.call("RPOP", KEYS[3 * k - 2])
+        if not id then
+            break
+        end
+        ids[#ids + 1] = id
+    end
+    if #ids > 0 then
+        redis.call("SREM", KEYS[3 * k - 1], unpack(ids))
+        for i, id in ipairs(ids) do
+            redis.call("ZADD", KEYS[3 * k], ARGV[2], id)
+        end
+        return {k, ids}
+    end
+end
+return nil
+"""
+
+# KEYS: inflight ARGV: deadline, ids
+# 只延长仍在 inflight 中的 id 的租约, 已 ack 或已被 reap 的 id 不受影响
+_EXTEND_SCRIPT = """
+local n = 0
+for i = 2, #ARGV do
+    if redis.call("ZSCORE", KEYS[1], ARGV[i]) then
+        redis.call("ZADD", KEYS[1], ARGV[1], ARGV[i])
+        n = n + 1
+    end
+end
+return n
+"""
+
+# KEYS: queue high, queue normal, queue low, pending, inflight, lanes ARGV: now
+# 租约过期的 id 放回原优先级队列的头部, 尽快被重新处理
+_REAP_SCRIPT = """
+local ids = redis.call("ZRANGEBYSCORE", KEYS[5], "-inf", ARGV[1])
+for i, id in ipairs(ids) do
+    redis.call("ZREM", KEYS[5], id)
+    if redis.call("SADD", KEYS[4], id) == 1 then
+        local lane = tonumber(redis.call("HGET", KEYS[6], id)) or 2
+        redis.call("RPUSH", KEYS[lane], id)
+    end
+end
+return #ids
+"""
+
+# KEYS: inflight, retry, attempts, dead, lanes
+# ARGV: id, now, base delay, max delay, max attempts, error, message
+# 返回已失败次数, 超过最大次数时放入 dead
+_RETRY_SCRIPT = """
+local id = ARGV[1]
+local now = tonumber(ARGV[2])
+redis.call("ZREM", KEYS[1], id)
+local n = redis.call("HINCRBY", KEYS[3], id, 1)
+if n > tonumber(ARGV[5]) then
+    redis.call("HDEL", KEYS[3], id)
+    redis.call("HDEL", KEYS[5], id)
+    local info = {error = ARGV[6], message = ARGV[7], attempts = n, time = now}
+    redis.call("HSET", KEYS[4], id, cjson.encode(info))
+else
+    local delay = math.min(tonumber(ARGV[4]), tonumber(ARGV[3]) * 2 ^ (n - 1))
+    redis.call("ZADD", KEYS[2], now + delay, id)
+end
+return n
+"""
+
+# KEYS: queue high, queue normal, queue low, pending, retry, lanes ARGV: now
+_PROMOTE_SCRIPT = """
+local ids = redis.call("ZRANGEBYSCORE", KEYS[5], "-inf", ARGV[1])
+for i, id in ipairs(ids) do
+    redis.call("ZREM", KEYS[5], id)
+    if redis.call("SADD", KEYS[4], id) == 1 then
+        local lane = tonumber(redis.call("HGET", KEYS[6], id)) or 2
+        redis.call("LPUSH", KEYS[lane], id)
+    end
+end
+return #ids
+"""
+
+
+def queue_key(key, lane=LANE_NORMAL):
+    if lane == LANE_NORMAL:
+        return key + QUEUE_SUFFIX
+    return "%s%s:%s" % (key, QUEUE_SUFFIX, lane)
+
+
+def queue_keys(key):
+    return [queue_key(key, lane) for lane in LANES]
+
+
+def pending_key(key):
+    return key + PENDING_SUFFIX
+
+
+def notify_key(key):
+    return key + NOTIFY_SUFFIX
+
+
+def lanes_key(key):
+    return key + LANES_SUFFIX
+
+
+def inflight_key(key):
+    return key + INFLIGHT_SUFFIX
+
+
+def retry_key(key):
+    return key + RETRY_SUFFIX
+
+
+def attempts_key(key):
+    return key + ATTEMPTS_SUFFIX
+
+
+def dead_key(key):
+    return key + DEAD_SUFFIX
+
+
+def priority_lane(priority):
+    """ 根据频道优先级(spider_channels.priority, 数值越大越优先)选择队列 """
+    try:
+        priority = int(priority or 0)
+    except (TypeError, ValueError):
+        return LANE_NORMAL
+    if priority >= PRIORITY_HIGH:
+        return LANE_HIGH
+    if priority <= PRIORITY_LOW:
+        return LANE_LOW
+    return LANE_NORMAL
+
+
+class TaskQueue(object):
+
+    def __init__(self, client):
+        self.client = client
+        self._push = client.register_script(_PUSH_SCRIPT)
+        self._pop = client.register_script(_POP_SCRIPT)
+        self._reap = client.register_script(_REAP_SCRIPT)
+        self._extend = client.register_script(_EXTEND_SCRIPT)
+        self._retry = client.register_script(_RETRY_SCRIPT)
+        self._promote = client.register_script(_PROMOTE_SCRIPT)
+
+    def _push_ids(self, key, ids, lane, client=None):
+        keys = [queue_key(key, lane), pending_key(key), lanes_key(key), notify_key(key)]
+        args = [LANES.index(lane) + 1, NOTIFY_MAX] + list(ids)
+        return self._push(keys=keys, args=args, client=client)
+
+    def push(self, key, *ids, **kwargs):
+        """ 将 id 放入任务队列, 已经在排队的 id 会被忽略
+
+        :param key: 任务 key, 如 main.KEY_DOWNLOAD_TASK
+        :type key: str
+        :param lane: 关键字参数, 优先级队列, 默认 LANE_NORMAL
+        :type lane: str
+        :return: 实际入队的数量
+        :rtype: int
+        """
+        if not ids:
+            return 0
+        return self._push_ids(key, ids, kwargs.get("lane", LANE_NORMAL))
+
+    def push_many(self, tasks, acks=None, lane=LANE_NORMAL):
+        """ 通过一次 pipeline 将多个任务 key 的 id 入队, 同时 ack 已处理完的 id
+
+        ack 的 id 同时清除失败次数
+
+        :param tasks: 任务 key 到 id 列表的映射
+        :type tasks: dict
+        :param acks: 任务 key 到已处理完的 id 列表的映射
+        :type acks: dict
+        :param lane: tasks 入队的优先级队列
+        :type lane: str
+        """
+        tasks = {key: ids for key, ids in tasks.items() if ids}
+        acks = {key: ids for key, ids in (acks or dict()).items() if ids}
+        if not (tasks or acks):
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for key, ids in tasks.items():
+            self._push_ids(key, ids, lane, client=pipe)
+        for key, ids in acks.items():
+            pipe.zrem(inflight_key(key), *ids)
+            pipe.hdel(attempts_key(key), *ids)
+            pipe.hdel(lanes_key(key), *ids)
+        pipe.execute()
+
+    def pop(self, keys, timeout=2, lease=LEASE_TIMEOUT):
+        """ 出队一个 id, 所有队列都为空时阻塞等待, 任意队列有 id 入队时立即返回
+
+        :param keys: 任务 key 列表, 同一优先级内靠前的 key 优先出队
+        :type keys: list of str
+        :param timeout: 最长等待秒数
+        :type timeout: int
+        :param lease: 租约时长(秒), 超时未 ack 的 id 会被 reap 重新入队
+        :type lease: int
+        :return: 任务 key, 优先级队列和 id, 超时返回 (None, None, None)
+        :rtype: (str, str, str)
+        """
+        key, lane, ids = self.pop_many(keys, 1, timeout=timeout, lease=lease)
+        return key, lane, ids[0] if ids else None
+
+    def pop_many(self, keys, count, timeout=2, lease=LEASE_TIMEOUT):
+        """ 批量出队, 按优先级从第一个非空的任务队列中最多取出 count 个 id
+
+        所有队列都为空时通过 BRPOP ``<key>:notify`` 阻塞等待, 直到任意队列有 id 入队或超时。
+        BRPOP 只用于唤醒, id 由 _POP_SCRIPT 出队并同时记录租约。
+        批次中的 id 依次处理, 租约时长为 count * lease
+
+        :param keys: 任务 key 列表, 同一优先级内靠前的 key 优先出队
+        :type keys: list of str
+        :param count: 最多取出的数量
+        :type count: int
+        :return: 任务 key, 优先级队列和 id 列表, 超时返回 (None, None, [])
+        :rtype: (str, str, list of str)
+        """
+        count = max(count, 1)
+        lease *= count
+        key, lane, ids = self._pop_many(keys, LANES, count, lease)
+        if ids:
+            return key, lane, ids
+        # 唤醒信号可能被其他消费者取走或已过期, 超时后同样再尝试一次, 重试和 reap 的 id 也由此取出
+        self.client.brpop([notify_key(k) for k in keys], timeout=timeout)
+        return self._pop_many(keys, LANES, count, lease)
+
+    def _pop_many(self, keys, lanes, count, lease):
+        entries = [(key, lane) for lane in lanes for key in keys]
+        names = list()
+        for key, lane in entries:
+            names.extend([queue_key(key, lane), pending_key(key), inflight_key(key)])
+        result = self._pop(keys=names, args=[count, time.time() + lease])
+        if not result:
+            return None, None, []
+        index, ids = result
+        key, lane = entries[index - 1]
+        return key, lane, ids
+
+    def extend(self, key, ids, lease=LEASE_TIMEOUT):
+        """ 将仍在处理中的 id 的租约延长到 lease 秒之后
+
+        :return: 延长了租约的数量
+        :rtype: int
+        """
+        if not ids:
+            return 0
+        return self._extend(keys=[inflight_key(key)], args=[time.time() + lease] + list(ids))
+
+    def keep_alive(self, key, ids, lease=LEASE_TIMEOUT):
+        """ 在 with 语句内每 lease / 3 秒延长一次 ids 的租约, 用于耗时较长的任务
+
+            with queue.keep_alive(key, ids, lease):
+                ...
+        """
+        return LeaseKeeper(self, key, ids, lease)
+
+    def ack(self, key, *ids):
+        """ 确认 id 已处理完成, 不再被 reap 重新入队 """
+        if ids:
+            self.push_many(dict(), acks={key: ids})
+
+    def retry(self, key, _id, error, max_attempts=RETRY_MAX_ATTEMPTS,
+              base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        """ 处理失败的 id 延迟重新入队, 第 n 次失败等待 min(max_delay, base_delay * 2^(n-1)) 秒
+
+        失败次数超过 max_attempts 时放入 dead, 记录错误类型和失败次数
+
+        :param key: 任务 key
+        :type key: str
+        :param _id: 处理失败的 id
+        :type _id: str
+        :param error: 导致失败的异常
+        :type error: Exception
+        :return: 已失败次数
+        :rtype: int
+        """
+        try:
+            message = str(error)
+        except UnicodeError:
+            message = repr(error)
+        keys = [inflight_key(key), retry_key(key), attempts_key(key), dead_key(key),
+                lanes_key(key)]
+        args = [_id, time.time(), base_delay, max_delay, max_attempts,
+                error.__class__.__name__, message]
+        n = self._retry(keys=keys, args=args)
+        if n > max_attempts:
+            logging.error("Give up %s of %s after %s attempts" % (_id, key, n))
+        return n
+
+    def promote(self, key):
+        """ 将到达重试时间的 id 重新放入原优先级队列
+
+        :return: 重新入队的数量
+        :rtype: int
+        """
+        keys = queue_keys(key) + [pending_key(key), retry_key(key), lanes_key(key)]
+        return self._promote(keys=keys, args=[time.time()])
+
+    def reap(self, key):
+        """ 将租约过期的 id 重新放入原优先级队列
+
+        :return: 租约过期的数量
+        :rtype: int
+        """
+        keys = queue_keys(key) + [pending_key(key), inflight_key(key), lanes_key(key)]
+        n = self._reap(keys=keys, args=[time.time()])
+        if n:
+            logging.warning("Reap %s expired ids of %s" % (n, key))
+        return n
+
+    def size(self, key):
+        pipe = self.client.pipeline(transaction=False)
+        for name in queue_keys(key):
+            pipe.llen(name)
+        return sum(pipe.execute())
+
+    def migrate(self, key):
+        """ 将旧版本 set 中遗留的 id 转移到任务队列 """
+        n = 0
+        while 1:
+            _id = self.client.spop(key)
+            if _id is None:
+                break
+            n += self.push(key, _id)
+        if n:
+            logging.info("Migrate %s ids from set %s" % (n, key))
+        return n
+
+
+class LeaseKeeper(object):
+    """ 在后台线程中定期延长 ids 的租约, 直到 with 语句结束 """
+
+    def __init__(self, queue, key, ids, lease):
+        self.queue = queue
+        self.key = key
+        self.ids = list(ids)
+        self.lease = lease
+        self._stopped = Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(max(1, self.lease / 3)):
+            try:
+                self.queue.extend(self.key, self.ids, self.lease)
+            except Exception as e:  # 下一次再延长, 租约过期前有多次机会
+                logging.warning("Extend lease of %s error: %s" % (self.key, e))
+
+    def __enter__(self):
+        self._thread = Thread(target=self._run, name="lease-%s" % self.key)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        return False
+
+
+queue = TaskQueue(redis)
@@ -8,18 +8,25 @@ import logging
 import time
 
 from bson import ObjectId
-from pymongo.errors import DuplicateKeyError
+from tornado.httpclient import HTTPError
 
+from spiders.business.blobs import load_pages, store_pages
 from spiders.business.cleaner import NewsCleaner
 from spiders.business.cleaner import is_news_valid
 from spiders.business.comments import get_comment_url
 from spiders.business.consts import FORM_NEWS, FORM_VIDEO, FORM_ATLAS, FORM_JOKE, FORM_PICTURE
+from spiders.business.detailcache import parse_detail, record_redirect, record_unsupported
+from spiders.business.detailcache import unsupported_urls
+from spiders.business.revisit import record_yield
 from spiders.business.subscribe import qdzx
-from spiders.business.utils import COL_CONFIGS, COL_REQUESTS, COL_CHANNELS
+from spiders.business.utils import COL_REQUESTS
 from spiders.business.utils import COL_NEWS, COL_ATLAS, COL_JOKE, COL_VIDEO, COL_PICTURE
 from spiders.business.utils import db_third_party as db
+from spiders.business.utils import channels, get_config_channel, insert_requests
 from spiders.business.utils import request_from_config_request
 from spiders.business.utils import is_advertisement
+from spiders.business.validators import get_validator, apply_validator, is_unchanged
+from spiders.business.validators import save_validator, touch_validator
 from spiders.business import jokes as jparser
 from spiders.business import videos as vparser
 from spiders.business.videos import video_autohome_parser
@@ -28,7 +35,8 @@ from spiders.business.videos import video_thepaper_parser
 from spiders.business.videos import video_weibo_parser
 from spiders.business.videos import video_yingtu_parser
 from spiders.business.videos import video_miaopai_parser
-from spiders.error import NotSupportError, ImageDownloadError
+from spiders.error import NotSupportError, ImageError, ImageDownloadError
+from spiders.error import HostUnavailableError
 from spiders.images import choose_feed_images, download_and_upload_images
 from spiders.images import get_feed_size
 from spiders.models import NewsFields, ListFields, ForeignFields, AtlasFields
@@ -38,6 +46,7 @@ from spiders.parsers.page import PageParser
 from spiders.utilities import get_string_md5, utc_datetime_now
 from spiders.utilities import http, format_datetime_string, clean_date_time
 from spiders.utilities import rebuild_url
+from spiders.utilities import canonicalize_url
 from spiders.utilities.http import Request, response_url_content
 
 PROCEDURE_LIST_TASK = 0  # 完成列表页解析状态
@@ -53,6 +62,7 @@ PROCEDURE_RESOURCE_UPLOAD_ERROR = 42000  # 资源上传失败状态
 PROCEDURE_PREPARE_TASK = 50000  # 完成资讯字段准备状态
 PROCEDURE_STORE_TASK = 60000  # 完成资讯分表存储状态
 PROCEDURE_STORE_ERROR = 61000  # 存储失败
+PAGE_CONCURRENCY = 8  # 同时下载的翻页数
 tmsnow = lambda: int(time.time()*1000)
 tsnow = lambda: int(time.time())
 
@@ -85,8 +95,7 @@ def run_list_task(_id, debug=False):
     :return: 新插入的 COL_REQUESTS 表的 _id 列表 
     :rtype: list of str
     """
-    config = db[COL_CONFIGS].find_one({"_id": ObjectId(_id)})
-    channel = db[COL_CHANNELS].find_one({"_id": ObjectId(config["channel"])})
+    config, channel = get_config_channel(_id)
     if channel["site"] == "585b6f3f3deaeb61dd2e288b":  # 百度参数需添加 ts 字段
         config["request"]["params"]["ts"] = [int(time.time())]
     elif channel["site"] == "5862342c3deaeb61dd2e2890":  # 号外参数需要添加 lastTime 字段
@@ -105,7 +114,19 @@ def run_list_task(_id, debug=False):
         config["request"]["params"]["last_refresh_sub_entrance_interval"] = s
         config["request"]["params"]["min_behot_time"] = s - 7200
     req = request_from_config_request(config["request"])
-    response = http.download(req)
+    validator = dict() if debug else get_validator(_id)
+    apply_validator(req, validator)
+    try:
+        response = http.download(req)
+    except HTTPError as e:
+        if e.code != 304:
+            raise
+        response = None
+    if response is None or is_unchanged(response, validator):  # 列表页没有变化, 不再解析
+        logging.info("List not modified config: %s" % _id)
+        touch_validator(_id)
+        record_yield(_id, 0, 0)
+        return list()
     url, content = http.response_url_content(response)
     if channel["site"] == "5862342c3deaeb61dd2e2890":  # 号外列表页有下载
         result = parse_list_haowai(document=content, url=url)
@@ -113,11 +134,16 @@ def run_list_task(_id, debug=False):
         result = FeedParser(document=content, crawler=config["crawler"], url=url)
     if len(result) == 0:  # Todo: 列表页解析失败
         logging.error("List parse error channel: %s config: %s" % (config["channel"], _id))
+        if not debug:
+            record_yield(_id, 0, 0)
         return None
     if debug:
         logging.info("List length: %s config: %s" % (len(result), _id))
         return result
-    ids = list()
+    docs = list()
+    unsupported = set()
+    if channel["form"] in (FORM_NEWS, FORM_ATLAS):  # 需要解析详情页的类型
+        unsupported = unsupported_urls([item["url"] for item in result])
     for item in result:
         middle = _request_doc_from_config_channel(config, channel)
         fields = ListFields()
@@ -135,17 +161,22 @@ def run_list_task(_id, debug=False):
             fields.comment = get_comment_url(channel["site"], comment_id)
         middle["list_fields"] = fields.to_dict()
         middle["pages"] = [{"url": item["url"], "html": ""}]
-        middle["unique"] = item["url"]  # 以 url 作为唯一性约束,避免重复抓取 TODO: 归一化url
+        middle["unique"] = canonicalize_url(item["url"])  # 以归一化的 url 作为唯一性约束,避免重复抓取
         middle["procedure"] = PROCEDURE_LIST_TASK
-        try:
-            r = db[COL_REQUESTS].insert_one(middle)  # fixme: 插入失败
-        except DuplicateKeyError:
-            pass
-        except Exception as e:
-            logging.error(e.message, exc_info=True)
-        else:
-            ids.append(str(r.inserted_id))
-    return ids
+        if item["url"] in unsupported:  # 不下载, 添加解析配置后可以重新分发
+            middle["procedure"] = PROCEDURE_DETAIL_NOT_SUPPORT_DOMAIN
+        docs.append(middle)
+    ids = insert_requests(docs)
+    save_validator(_id, response)  # 插入成功后才记录, 失败重试时仍会重新解析
+    record_yield(_id, len(ids), len(result))
+    # insert_many 会为文档设置 _id, 只有 ids 中的文档确实插入了, 重复的文档不再计数
+    inserted = set(ids)
+    parked = set()
+    for doc in docs:
+        if doc["procedure"] == PROCEDURE_DETAIL_NOT_SUPPORT_DOMAIN and str(doc.get("_id")) in inserted:
+            parked.add(str(doc["_id"]))
+            record_unsupported(doc["pages"][0]["url"])
+    return [i for i in ids if i not in parked]
 
 
 # 新闻,图集特有
@@ -166,55 +197,73 @@ def run_download_task(_id, debug=False):
         try:
             response = http.download(req)
             url, content = response_url_content(response)
-        except Exception:
+        except HostUnavailableError:
+            raise
+        except Exception as e:
+            if isinstance(e, HTTPError) and e.code == 599:  # 超时或连接失败, 换用 requests 也不会成功
+                raise
             url, content = http.stable_download_content(url)
         return url, content
 
+    def _download_many(urls):
+        """ 并发下载翻页, 结果与 urls 顺序相同
+
+        失败的页面单独使用 requests 重新下载一次, 仍然失败时抛出异常, 整个任务稍后重试,
+        不保存缺少翻页的详情
+        """
+        requests = [Request.from_random_browser(url=u) for u in urls]
+        responses = http.multidownload(requests=requests, concurrency=PAGE_CONCURRENCY)
+        result = list()
+        for u, response in zip(urls, responses):
+            if response.error is None:
+                result.append(response_url_content(response))
+            else:
+                result.append(http.stable_download_content(u))
+        return result
+
     query = {"_id": ObjectId(_id)}
     request = db[COL_REQUESTS].find_one(query)
     pages = list(request["pages"])
     list_fields = request.get("list_fields", dict())
+    check_support = not debug and request["form"] in (FORM_NEWS, FORM_ATLAS)
     if list_fields.get("html"):
         pages[0]["html"] = list_fields["html"]
     else:
         current = pages[0]
         pages = list()
         url, content = _download(current["url"])
+        if check_support:
+            record_redirect(current["url"], url)
+            if not DetailParser.supports(url):  # 跳转后的链接没有解析配置, 不再下载翻页
+                logging.error("Detail parse error(domain not support): %s" % _id)
+                record_unsupported(url)
+                update_error_message(_id, "domain not support", PROCEDURE_DETAIL_NOT_SUPPORT_DOMAIN)
+                return None
         pages.append(new_page_object(url, content))
         urls = PageParser(document=content, url=url)
-        for u in urls:
-            url, content = _download(u)
+        for url, content in _download_many(urls):
             pages.append(new_page_object(url, content))
     if debug:
         return pages
-    update = {"$set": {"procedure": PROCEDURE_DOWNLOAD_TASK, "pages": pages}}
+    update = {"$set": {"procedure": PROCEDURE_DOWNLOAD_TASK, "pages": store_pages(pages)}}
     db[COL_REQUESTS].update_one(query, update=update)
     return _id
 
 
-# 新闻,图集特有
-def run_detail_task(_id):
-    """ 解析详情页(非耗时任务) 
-    
-    :param _id: COL_REQUESTS 表 _id
-    :type _id: str
-    :return: COL_REQUESTS 表 _id
-    :rtype: str
-    """
-    query = {"_id": ObjectId(_id)}
-    collection = db[COL_REQUESTS]
-    request = collection.find_one(query)
-    pages = request["pages"]
+def _detail_update(_id, request):
+    """ 解析详情页, 返回更新 COL_REQUESTS 表的 update """
+    pages = load_pages(request["pages"])
     if request["form"] == FORM_NEWS:
         news = NewsFields()
     elif request["form"] == FORM_ATLAS:
         news = AtlasFields()
     else:
         raise NotSupportError("run detail task not support %s" % request["form"])
-    url, html = pages[0]["url"], pages[0]["html"]
-    result = DetailParser(url=url, document=html)
+    url = pages[0]["url"]
+    result = parse_detail(pages[0])
     if not result["support"]:
         logging.error("Detail parse error(domain not support): %s" % _id)
+        record_unsupported(url)
         update = {"$set": {"procedure": PROCEDURE_DETAIL_NOT_SUPPORT_DOMAIN}}
     elif result["missing"]:
         logging.warning("Detail parse warn(miss some fields): %s" % _id)
@@ -229,21 +278,32 @@ def run_detail_task(_id):
             news.tags = result["tags"]
         news.content = result["content"]
         news.publish_ori_url = url
-        for page in request["pages"][1:]:
-            result = DetailParser(url=page["url"], document=page["html"])
+        for page in pages[1:]:
+            result = parse_detail(page)
             news.content.extend(result["content"])
         update = {"$set": {"procedure": PROCEDURE_DETAIL_TASK, "fields": news.to_dict()}}
-    collection.update_one(query, update=update)
-    return _id if update["$set"]["procedure"] == PROCEDURE_DETAIL_TASK else None
+    return update
 
 
-# 通用步骤
-def run_clean_filter_task(_id):
-    """ 初步清洗,过滤资讯(非耗时任务) """
+# 新闻,图集特有
+def run_detail_task(_id):
+    """ 解析详情页(非耗时任务) 
+    
+    :param _id: COL_REQUESTS 表 _id
+    :type _id: str
+    :return: COL_REQUESTS 表 _id
+    :rtype: str
+    """
     query = {"_id": ObjectId(_id)}
     collection = db[COL_REQUESTS]
-    projection = {"pages": 0}
-    request = collection.find_one(query, projection=projection)
+    request = collection.find_one(query)
+    update = _detail_update(_id, request)
+    collection.update_one(query, update=update)
+    return _id if update["$set"]["procedure"] == PROCEDURE_DETAIL_TASK else None
+
+
+def _clean_filter_update(_id, request):
+    """ 清洗过滤资讯, 返回更新 COL_REQUESTS 表的 update """
     form = request["form"]
     fields = request["fields"]
     list_fields = request.get("list_fields", dict())
@@ -266,19 +326,34 @@ def run_clean_filter_task(_id):
     else:
         raise NotSupportError("Not support clean request id: %s" % _id)
     update["$set"]["procedure"] = procedure
+    return update
+
+
+# 通用步骤
+def run_clean_filter_task(_id):
+    """ 初步清洗,过滤资讯(非耗时任务) """
+    query = {"_id": ObjectId(_id)}
+    collection = db[COL_REQUESTS]
+    projection = {"pages": 0}
+    request = collection.find_one(query, projection=projection)
+    update = _clean_filter_update(_id, request)
     collection.update_one(query, update=update)
-    return _id if procedure == PROCEDURE_CLEAN_TASK else None
+    return _id if update["$set"]["procedure"] == PROCEDURE_CLEAN_TASK else None
 
 
 def news_resource_images(content, refer, form):
+    """ 下载上传正文中的图片
+
+    :return: 更新 COL_REQUESTS 表的 update 和下载上传图片时的异常(没有异常时为 None)
+    :rtype: (dict, Exception)
+    """
     procedure = PROCEDURE_RESOURCE_TASK
+    error = None
     n_images, n_videos, n_audios = 0, 0, 0
     image_urls = OrderedDict()
     for i, item in enumerate(content):
         if item["tag"] == "img":
             image_urls[i] = item["src"]
-            item["org"] = item["src"]
-            item["src"] = ""
             n_images += 1
         elif item["tag"] in ["video", "object"]:
             n_videos += 1
@@ -289,16 +364,22 @@ def news_resource_images(content, refer, form):
             images = download_and_upload_images(image_urls.values(), refer=refer)
         except ImageDownloadError as e:
             procedure = PROCEDURE_RESOURCE_DOWNLOAD_ERROR
+            error = e
             logging.error(e.message)
         except Exception as e:
             procedure = PROCEDURE_RESOURCE_UPLOAD_ERROR
+            error = e
             logging.error(e.message, exc_info=True)
         else:
             for i, item in enumerate(image_urls.items()):
                 index, _url = item
                 image = images[i]
                 image["ad"] = is_advertisement(image["md5"], _url)
+                content[index]["org"] = _url
+                content[index]["src"] = ""
                 content[index].update(image)
+        if error is not None:  # 正文没有修改, 保留原始的正文以便重试
+            return {"$set": {"procedure": procedure}}, error
     update = {"$set": {
         "fields.content": content,
         "fields.n_images": n_images,
@@ -307,53 +388,64 @@ def news_resource_images(content, refer, form):
     if form == FORM_NEWS:
         update["$set"]["fields.n_videos"] = n_videos
         update["$set"]["fields.n_audios"] = n_audios
-    return update
+    return update, None
 
 
-# 通用步骤
-def run_resource_task(_id):
-    """ 下载需要的资源(耗时任务) """
-    query = {"_id": ObjectId(_id)}
-    projection = {"fields": 1, "unique": 1, "form": 1, "list_fields": 1}
-    col = db[COL_REQUESTS]
-    r = col.find_one(query, projection=projection)
-    refer = r["unique"] if r["unique"].startswith("http") else None
-    form = r["form"]
+def _resource_update(request):
+    """ 下载上传缩略图和正文图片
+
+    :return: 更新 COL_REQUESTS 表的 update 和下载上传图片时的异常(没有异常时为 None)
+    :rtype: (dict, Exception)
+    """
+    # unique 是归一化的 url(强制 http, 可能去掉了参数), referer 使用原始的页面 url
+    refer = request.get("fields", dict()).get("publish_ori_url") or \
+        request.get("list_fields", dict()).get("url") or None
+    form = request["form"]
+    thumbs = None
+    error = None
     if form == FORM_NEWS or form == FORM_ATLAS:  # 处理新闻和图集的资源
-        feeds = r["list_fields"].get("thumbs")
-        if feeds:  # 处理列表页抓到的缩略图
+        feeds = request["list_fields"].get("thumbs")
+        if feeds and not isinstance(feeds[0], dict):  # 处理列表页抓到的缩略图, 重试时已处理过
             try:
-                images = download_and_upload_images(feeds, refer=refer)
+                thumbs = download_and_upload_images(feeds, refer=refer)
             except Exception as e:
                 logging.error(e.message, exc_info=True)
-                images = list()
-            update = {"$set": {"list_fields.thumbs": images}}
-            col.update_one(query, update=update)
-        update = news_resource_images(r["fields"]["content"], refer, form)
+                thumbs = list()
+        update, error = news_resource_images(request["fields"]["content"], refer, form)
     else:
         update = {"$set": {"procedure": PROCEDURE_RESOURCE_TASK}}
-    col.update_one(query, update=update)
-    return _id if update["$set"]["procedure"] == PROCEDURE_RESOURCE_TASK else None
+    if thumbs is not None:  # 图片失败时也保存缩略图, 重试时不再重复上传
+        update["$set"]["list_fields.thumbs"] = thumbs
+    return update, error
 
 
 # 通用步骤
-def run_prepare_task(_id):
-    """ 准备数据，生成一些必要的字段(耗时任务)
-     
-     为新闻生成 fields.gen_feeds 字段(列表页图)
+def run_resource_task(_id):
+    """ 下载需要的资源(耗时任务)
+
+    图片下载或上传失败时抛出 ImageError, 由任务队列稍后重试
     """
     query = {"_id": ObjectId(_id)}
-    projection = {"fields": 1, "form": 1, "list_fields": 1}
+    projection = {"fields": 1, "unique": 1, "form": 1, "list_fields": 1}
     col = db[COL_REQUESTS]
     r = col.find_one(query, projection=projection)
-    form = r["form"]
+    update, error = _resource_update(r)
+    col.update_one(query, update=update)
+    if isinstance(error, ImageError):
+        raise error
+    return _id if update["$set"]["procedure"] == PROCEDURE_RESOURCE_TASK else None
+
+
+def _prepare_update(request):
+    """ 生成列表页图等字段, 返回更新 COL_REQUESTS 表的 update """
+    form = request["form"]
     if form == FORM_NEWS or form == FORM_ATLAS:  # 处理新闻需要的字段
-        ori_feeds = r["list_fields"].get("thumbs", list())
+        ori_feeds = request["list_fields"].get("thumbs", list())
         if ori_feeds:
             urls = [item["src"] for item in ori_feeds]
             ori_feeds = choose_feed_images(urls=urls, flag=False) if urls else list()
         urls = list()
-        for item in r["fields"]["content"]:
+        for item in request["fields"]["content"]:
             if item["tag"] == "img":
                 w, h = get_feed_size(item.get("width", 0), item.get("height", 0))
                 if w == 0 or h == 0 or item.get("qr") or item.get("gray") or item.get("ad"):
@@ -367,13 +459,26 @@ def run_prepare_task(_id):
         }}
     else:  # Todo: 处理其他资讯需要的字段
         update = {"$set": {"procedure": PROCEDURE_PREPARE_TASK}}
+    return update
+
+
+# 通用步骤
+def run_prepare_task(_id):
+    """ 准备数据，生成一些必要的字段(耗时任务)
+     
+     为新闻生成 fields.gen_feeds 字段(列表页图)
+    """
+    query = {"_id": ObjectId(_id)}
+    projection = {"fields": 1, "form": 1, "list_fields": 1}
+    col = db[COL_REQUESTS]
+    r = col.find_one(query, projection=projection)
+    update = _prepare_update(r)
     col.update_one(query, update=update)
     return _id
 
 
-# 通用步骤
-def run_store_task(_id):
-    """ requests 表中的内容分表存储 """
+def _store_update(_id, request):
+    """ 资讯存入对应的分表, 返回更新 COL_REQUESTS 表的 update """
     mapping = {
         FORM_NEWS: COL_NEWS,
         FORM_VIDEO: COL_VIDEO,
@@ -381,10 +486,7 @@ def run_store_task(_id):
         FORM_ATLAS: COL_ATLAS,
         FORM_PICTURE: COL_PICTURE,
     }
-    query = {"_id": ObjectId(_id)}
-    projection = {"pages": 0}
-    request = db[COL_REQUESTS].find_one(query, projection=projection)
-    channel = db[COL_CHANNELS].find_one({"_id": ObjectId(request["channel"])})
+    channel = channels.get(request["channel"])
     form = request["form"]
     foreign = ForeignFields()
     foreign.site = str(channel["site"])
@@ -395,7 +497,7 @@ def run_store_task(_id):
     foreign.category2 = channel.get("category2", "")
     foreign.priority = channel["priority"]
     list_fields = request.get("list_fields", dict())
-    fields = request["fields"]
+    fields = dict(request["fields"])  # 合并到副本, pipeline 中不写回 COL_REQUESTS 的 fields
     for k, v in list_fields.items():
         if k in fields and k != "title" and v:
             fields[k] = v
@@ -414,9 +516,82 @@ def run_store_task(_id):
         logging.info("Store %s: %s" % (form, id))
         data = {"col": mapping[form], "_id": id}
         qdzx(data)
+    return update
+
+
+# 通用步骤
+def run_store_task(_id):
+    """ requests 表中的内容分表存储 """
+    query = {"_id": ObjectId(_id)}
+    projection = {"pages": 0}
+    request = db[COL_REQUESTS].find_one(query, projection=projection)
+    # 任务可能被重复执行(租约过期后重新入队), 已经存储过的不再重复插入分表和推送
+    if request.get("store_id") or request["procedure"] >= PROCEDURE_STORE_TASK:
+        logging.warning("Request already stored: %s" % _id)
+        return
+    update = _store_update(_id, request)
     db[COL_REQUESTS].update_one(query, update)
 
 
+def _apply_update(request, update, touched):
+    """ 将 update 的 $set 应用到内存中的文档, 记录修改过的顶层字段
+
+    :return: 更新后的 procedure
+    :rtype: int
+    """
+    for name, value in update["$set"].items():
+        keys = name.split(".")
+        target = request
+        for key in keys[:-1]:
+            target = target.setdefault(key, dict())
+        target[keys[-1]] = value
+        touched.add(keys[0])
+    return request["procedure"]
+
+
+def _flush_request(query, request, touched):
+    """ 将内存中修改过的顶层字段写回 COL_REQUESTS 表 """
+    if touched:
+        update = {"$set": {name: request[name] for name in touched}}
+        db[COL_REQUESTS].update_one(query, update=update)
+        touched.clear()
+
+
+# 通用步骤
+def run_pipeline_task(_id):
+    """ 在同一进程内完成详情页解析, 清洗过滤, 资源处理, 字段准备和分表存储(耗时任务)
+
+    只读取一次 COL_REQUESTS, 各步骤的更新先应用到内存中的文档, 在资源处理之后
+    (避免重试时重复上传图片)和全部结束时写回。根据 procedure 从上次中断的步骤继续,
+    与分步执行的任务使用相同的 procedure, 两种方式可以混用。
+    图片下载或上传失败时抛出 ImageError, 由任务队列稍后重试
+
+    :param _id: COL_REQUESTS 表 _id
+    :type _id: str
+    """
+    query = {"_id": ObjectId(_id)}
+    request = db[COL_REQUESTS].find_one(query)
+    touched = set()
+    procedure = request["procedure"]
+    if procedure == PROCEDURE_DOWNLOAD_TASK:
+        procedure = _apply_update(request, _detail_update(_id, request), touched)
+        request.pop("pages", None)  # 之后的步骤不需要页面内容
+    if procedure == PROCEDURE_DETAIL_TASK:
+        procedure = _apply_update(request, _clean_filter_update(_id, request), touched)
+    if procedure in (PROCEDURE_CLEAN_TASK, PROCEDURE_RESOURCE_DOWNLOAD_ERROR,
+                     PROCEDURE_RESOURCE_UPLOAD_ERROR):
+        update, error = _resource_update(request)
+        procedure = _apply_update(request, update, touched)
+        _flush_request(query, request, touched)
+        if isinstance(error, ImageError):
+            raise error
+    if procedure == PROCEDURE_RESOURCE_TASK:
+        procedure = _apply_update(request, _prepare_update(request), touched)
+    if procedure == PROCEDURE_PREPARE_TASK and not request.get("store_id"):
+        _apply_update(request, _store_update(_id, request), touched)
+    _flush_request(query, request, touched)
+
+
 # 视频特有
 def run_video_task(_id, debug=False):
     """  视频抓取解析, 新建 requests 记录
@@ -442,8 +617,7 @@ def run_video_task(_id, debug=False):
         "57bc0afeda083a1c19957b29": vparser.video_duowan_parser,
         "57c64e49fe8eca2b7946609a": vparser.video_ifeng_parser,
     }
-    config = db[COL_CONFIGS].find_one({"_id": ObjectId(_id)})
-    channel = db[COL_CHANNELS].find_one({"_id": ObjectId(config["channel"])})
+    config, channel = get_config_channel(_id)
     site_id = channel["site"]
     parser = site_parser_mapping.get(site_id)
     if not parser:
@@ -452,23 +626,18 @@ def run_video_task(_id, debug=False):
     params = config["request"].get("params", dict())
     if params:
         url = rebuild_url(url,params)
-    ids = list()
     videos = parser(url)
     if debug:
         return [video.to_dict() for video in videos]
+    docs = list()
     for video in videos:
         doc = _request_doc_from_config_channel(config, channel)
         doc["fields"] = video.to_dict()
-        doc["unique"] = video.publish_ori_url
+        doc["unique"] = canonicalize_url(video.publish_ori_url)
         doc["procedure"] = PROCEDURE_DETAIL_TASK
-        try:
-            r = db[COL_REQUESTS].insert_one(doc)  # fixme: 插入失败
-        except DuplicateKeyError:
-            pass
-        except Exception as e:
-            logging.error(e.message, exc_info=True)
-        else:
-            ids.append(str(r.inserted_id))
+        docs.append(doc)
+    ids = insert_requests(docs)
+    record_yield(_id, len(ids), len(videos))
     return ids
 
 
@@ -491,8 +660,7 @@ def run_joke_task(_id, debug=False):
         "598c00da921e6d6faaa02610": jparser.joke_helegehe_parser,
         "598c0241921e6d6f9aa026ac": jparser.joke_khdx_parser,
     }
-    config = db[COL_CONFIGS].find_one({"_id": ObjectId(_id)})
-    channel = db[COL_CHANNELS].find_one({"_id": ObjectId(config["channel"])})
+    config, channel = get_config_channel(_id)
     site_id = channel["site"]
     parser = site_parser_mapping.get(site_id)
     if not parser:
@@ -501,23 +669,18 @@ def run_joke_task(_id, debug=False):
     params = config["request"].get("params", dict())
     if params:
         url = rebuild_url(url, params)
-    ids = list()
     jokes = parser(url)
     if debug:
         return [joke.to_dict() for joke in jokes]
+    docs = list()
     for joke in jokes:
         doc = _request_doc_from_config_channel(config, channel)
         doc["fields"] = joke.to_dict()
         doc["unique"] = get_string_md5(joke.text)
         doc["procedure"] = PROCEDURE_DETAIL_TASK
-        try:
-            r = db[COL_REQUESTS].insert_one(doc)
-        except DuplicateKeyError:
-            pass
-        except Exception as e:
-            logging.error(e.message, exc_info=True)
-        else:
-            ids.append(str(r.inserted_id))
+        docs.append(doc)
+    ids = insert_requests(docs)
+    record_yield(_id, len(ids), len(jokes))
     return ids
 
 
@@ -1,8 +1,17 @@
 # coding: utf-8
 
+from copy import deepcopy
+import logging
+from threading import Lock
+import time
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
 from spiders.resource import get_cache_client
 from spiders.resource import get_mongodb_database
 from spiders.utilities import http
+from spiders.utilities.bloom import BloomFilter
 from spiders.utilities import rebuild_url, url_encode_params
 
 KEY_RECEIVE = "spiders:schedule:config:id"
@@ -16,9 +25,160 @@ COL_VIDEO = "v1_video"
 COL_JOKE = "v1_joke"
 COL_PICTURE = "v1_picture"
 COL_ADVERTISEMENT = "spider_advertisements"
+COL_PAGES = "v1_pages"
+KEY_SEEN_REQUESTS = "v1:spider:bloom:request"
 
 redis = get_cache_client(db=2)
 db_third_party = get_mongodb_database("thirdparty", "third")
+seen_requests = BloomFilter(redis, KEY_SEEN_REQUESTS)  # 最近插入过的 COL_REQUESTS unique
+# 过渡期: canonicalize_url 之前的 unique 为原始 url, 插入前同时检查原始 url, 避免已抓取的文章重复插入,
+# 列表页上不再有旧文章之后可以关闭
+CHECK_RAW_UNIQUE = True
+CACHE_TTL = 300  # 缓存的 config, channel 文档有效秒数
+
+
+class CachedCollection(object):
+    """ 按 _id 缓存很少修改的集合(spider_configs, spider_channels)的文档
+
+    缓存的文档 CACHE_TTL 秒后过期, 可以通过 warm 批量加载, 通过 refresh 按文档的
+    modified 字段增量更新, 修改文档后可以通过 invalidate 立即失效。
+    get 返回文档的副本, 调用方可以随意修改(如 run_list_task 修改 config 的请求参数)。
+    """
+
+    def __init__(self, name, ttl=CACHE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self._docs = dict()  # ObjectId -> (过期时间, 文档)
+        self._modified = None  # 已加载文档中最大的 modified
+        self._lock = Lock()
+
+    def _put(self, docs):
+        expire = time.time() + self.ttl
+        with self._lock:
+            for doc in docs:
+                self._docs[doc["_id"]] = (expire, doc)
+                modified = doc.get("modified")
+                if modified is not None and (self._modified is None or modified > self._modified):
+                    self._modified = modified
+
+    def get(self, _id):
+        """ 根据 _id 获取文档, 不存在时返回 None
+
+        :param _id: 文档 _id
+        :type _id: str or ObjectId
+        :rtype: dict
+        """
+        _id = ObjectId(_id)
+        with self._lock:
+            item = self._docs.get(_id)
+        if item is None or item[0] < time.time():
+            doc = db_third_party[self.name].find_one({"_id": _id})
+            if doc is None:
+                return None
+            self._put([doc])
+        else:
+            doc = item[1]
+        return deepcopy(doc)
+
+    def warm(self):
+        """ 批量加载集合中所有的文档
+
+        :return: 加载的文档数量
+        :rtype: int
+        """
+        docs = list(db_third_party[self.name].find())
+        self._put(docs)
+        return len(docs)
+
+    def refresh(self):
+        """ 重新加载 modified 比已加载的文档更新的文档, 没有 modified 字段的集合只依靠过期时间
+
+        :return: 重新加载的文档数量
+        :rtype: int
+        """
+        if self._modified is None:
+            return 0
+        query = {"modified": {"$gt": self._modified}}
+        docs = list(db_third_party[self.name].find(query))
+        self._put(docs)
+        return len(docs)
+
+    def invalidate(self, _id=None):
+        """ 使 _id 对应的文档失效, _id 为 None 时清空缓存 """
+        with self._lock:
+            if _id is None:
+                self._docs.clear()
+                self._modified = None
+            else:
+                self._docs.pop(ObjectId(_id), None)
+
+
+configs = CachedCollection(COL_CONFIGS)
+channels = CachedCollection(COL_CHANNELS)
+
+
+def get_config_channel(_id):
+    """ 获取 spider_configs 表 _id 对应的 config 和 channel (缓存)
+
+    :param _id: spider_configs 表 _id
+    :type _id: str
+    :rtype: (dict, dict)
+    """
+    config = configs.get(_id)
+    channel = channels.get(config["channel"])
+    return config, channel
+
+
+def raw_unique(doc):
+    """ 文档归一化之前的 unique(详情页或视频的原始 url), 与归一化的 unique 相同或没有时返回 None """
+    pages = doc.get("pages")
+    url = pages[0]["url"] if pages else doc.get("fields", dict()).get("publish_ori_url")
+    if url and url != doc["unique"]:
+        return url
+    return None
+
+
+def insert_requests(docs):
+    """ 通过一次 insert_many 批量插入 COL_REQUESTS, 忽略 unique 重复的文档
+
+    不在 seen_requests 中的文档直接插入, 更早的重复文档由 unique 索引拒绝;
+    在 seen_requests 中的 unique 可能是误判, 通过一次 $in 查询确认后只跳过确实已存在的文档。
+    CHECK_RAW_UNIQUE 时再通过一次 $in 查询跳过以原始 url 为 unique 插入过的文档。
+
+    :param docs: 待插入的文档
+    :type docs: list of dict
+    :return: 新插入的文档 _id 列表
+    :rtype: list of str
+    """
+    seen = seen_requests.contains_many([doc["unique"] for doc in docs])
+    hits = [doc["unique"] for doc, exist in zip(docs, seen) if exist]
+    if hits:
+        cursor = db_third_party[COL_REQUESTS].find({"unique": {"$in": hits}}, {"unique": 1})
+        existing = set(doc["unique"] for doc in cursor)
+        docs = [doc for doc in docs if doc["unique"] not in existing]
+    raws = [raw_unique(doc) for doc in docs] if CHECK_RAW_UNIQUE else list()
+    if any(raws):
+        cursor = db_third_party[COL_REQUESTS].find({"unique": {"$in": [raw for raw in raws if raw]}},
+                                                   {"unique": 1})
+        existing = set(doc["unique"] for doc in cursor)
+        docs = [doc for doc, raw in zip(docs, raws) if raw is None or raw not in existing]
+    if not docs:
+        return list()
+    failed = set()
+    try:
+        result = db_third_party[COL_REQUESTS].insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            if error["code"] != 11000:  # 11000 为 unique 重复, 同样记录到 seen_requests
+                failed.add(error["index"])
+                logging.error("Insert request error: %s" % error["errmsg"])
+        # insert_many 会为每个文档生成 _id, 未出错的文档均已插入
+        errors = set(error["index"] for error in e.details["writeErrors"])
+        ids = [str(doc["_id"]) for i, doc in enumerate(docs) if i not in errors]
+    else:
+        ids = [str(_id) for _id in result.inserted_ids]
+    seen_requests.add_many([doc["unique"] for i, doc in enumerate(docs) if i not in failed])
+    return ids
 
 
 def request_from_config_request(r):
@@ -51,7 +211,68 @@ def request_from_config_request(r):
     return http.Request(url=url, **params)
 
 
+class AdvertisementIndex(object):
+    """ 内存中的广告图片 url 和 md5 索引
+
+    第一次使用时加载 COL_ADVERTISEMENT 的全部文档, 之后每 refresh_interval 秒按 _id 增量加载
+    新插入的文档, 每 reload_interval 秒全量重新加载一次(处理删除的文档)
+    """
+
+    def __init__(self, refresh_interval=60, reload_interval=3600):
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.urls = set()
+        self.md5s = set()
+        self._last_id = None  # 已加载的最大 _id
+        self._refreshed = 0
+        self._reloaded = 0
+        self._lock = Lock()
+
+    def _load(self, query, urls, md5s):
+        projection = {"url": 1, "md5": 1}
+        for doc in db_third_party[COL_ADVERTISEMENT].find(query, projection=projection):
+            if doc.get("url"):
+                urls.add(doc["url"])
+            if doc.get("md5"):
+                md5s.add(doc["md5"])
+            if self._last_id is None or doc["_id"] > self._last_id:
+                self._last_id = doc["_id"]
+
+    def _reload(self):
+        urls, md5s = set(), set()
+        self._last_id = None
+        self._load(dict(), urls, md5s)
+        self.urls, self.md5s = urls, md5s
+        self._refreshed = self._reloaded = time.time()
+
+    def _refresh(self):
+        query = {"_id": {"$gt": self._last_id}} if self._last_id else dict()
+        self._load(query, self.urls, self.md5s)
+        self._refreshed = time.time()
+
+    def reload(self):
+        """ 全量加载 """
+        with self._lock:
+            self._reload()
+
+    def refresh(self):
+        """ 增量加载 _id 比已加载的文档更大的文档 """
+        with self._lock:
+            self._refresh()
+
+    def contains(self, md5, url):
+        if time.time() - self._refreshed > self.refresh_interval:
+            with self._lock:  # 获得锁之后再次检查, 其他线程可能已经加载过
+                now = time.time()
+                if now - self._reloaded > self.reload_interval:
+                    self._reload()
+                elif now - self._refreshed > self.refresh_interval:
+                    self._refresh()
+        return url in self.urls or md5 in self.md5s
+
+
+advertisements = AdvertisementIndex()
+
+
 def is_advertisement(md5, url):
-    query = {"$or": [{"url": url}, {"md5": md5}]}
-    count = db_third_party[COL_ADVERTISEMENT].count(query)
-    return True if count > 0 else False
+    return advertisements.contains(md5, url)
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+""" 列表页的 HTTP 缓存验证信息
+
+每个 spider_config 在 redis hash ``v1:spider:validator:<config _id>`` 中记录上次成功解析的列表页的
+ETag, Last-Modified 和响应内容的 sha1。再次抓取时带上 If-None-Match/If-Modified-Since,
+服务端返回 304 或内容的 sha1 与上次相同时列表页没有变化, 不需要再解析。
+"""
+
+import hashlib
+
+from spiders.business.utils import redis
+
+KEY_PREFIX = "v1:spider:validator:"
+VALIDATOR_TTL = 2 * 86400  # 大于 revisit.MAX_INTERVAL, 长期不抓取的 config 自动清除
+
+
+def body_hash(body):
+    """ 响应内容的 sha1 """
+    return hashlib.sha1(body or "").hexdigest()
+
+
+def get_validator(_id):
+    """ config 上次成功解析的列表页的验证信息
+
+    :param _id: spider_configs 表 _id
+    :type _id: str
+    :return: {"etag": etag, "modified": last-modified, "hash": sha1}, 没有记录时为空
+    :rtype: dict
+    """
+    return redis.hgetall(KEY_PREFIX + _id)
+
+
+def apply_validator(request, validator):
+    """ 为请求添加条件请求的 header
+
+    :param request: 列表页请求
+    :type request: tornado.httpclient.HTTPRequest
+    :param validator: get_validator 的返回值
+    :type validator: dict
+    """
+    if validator.get("etag"):
+        request.headers["If-None-Match"] = validator["etag"]
+    if validator.get("modified"):
+        request.headers["If-Modified-Since"] = validator["modified"]
+
+
+def is_unchanged(response, validator):
+    """ 响应内容与上次成功解析的列表页是否相同 """
+    return bool(validator.get("hash")) and body_hash(response.body) == validator["hash"]
+
+
+def save_validator(_id, response):
+    """ 列表页解析成功后记录其验证信息
+
+    :param _id: spider_configs 表 _id
+    :type _id: str
+    :param response: 列表页响应
+    :type response: tornado.httpclient.HTTPResponse
+    """
+    validator = {"hash": body_hash(response.body)}
+    if response.headers.get("ETag"):
+        validator["etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        validator["modified"] = response.headers["Last-Modified"]
+    key = KEY_PREFIX + _id
+    pipe = redis.pipeline(transaction=False)
+    pipe.delete(key)
+    pipe.hmset(key, validator)
+    pipe.expire(key, VALIDATOR_TTL)
+    pipe.execute()
+
+
+def touch_validator(_id):
+    """ 列表页没有变化时延长验证信息的有效期 """
+    redis.expire(KEY_PREFIX + _id, VALIDATOR_TTL)
+
+
+def reset_validator(_id):
+    """ 清除 config 的验证信息, 下次抓取时重新解析(如修改了 config 或解析规则之后) """
+    redis.delete(KEY_PREFIX + _id)
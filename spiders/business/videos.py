@@ -16,7 +16,6 @@ import re
 from urllib import unquote_plus
 from urlparse import urljoin, urlparse, parse_qs
 from bs4 import BeautifulSoup
-from w3lib.encoding import html_to_unicode
 
 from spiders.models import VideoFields
 from spiders.parsers.utils import extract_tag_attribute
@@ -109,19 +108,9 @@ def video_zaker_parser(url):
 
 
 def video_weibo_downloader(url):
-    import requests
-    with requests.Session() as session:
-        session.cookies = requests.utils.cookiejar_from_dict(
-            {"SUB": "_2AkMvnF44dcPhrAJWm_EXzGzqaIhH-jycSTfOAn7uJhMyAxh77nc-qSWPCC49JGeSHgISGwk67XxQvGhEsQ.."},
-            cookiejar=None,
-            overwrite=True
-        )
-        response = session.get(url, timeout=(10, 30))
-        _, content = html_to_unicode(
-            content_type_header=response.headers.get("content-type"),
-            html_body_str=response.content
-        )
-        return content
+    cookies = {"SUB": "_2AkMvnF44dcPhrAJWm_EXzGzqaIhH-jycSTfOAn7uJhMyAxh77nc-qSWPCC49JGeSHgISGwk67XxQvGhEsQ.."}
+    response = http.get_session().get(url, cookies=cookies)
+    return http.decode_content(response.content, response.headers.get("content-type"), response.url)
 
 
 def video_weibo_parser(url):
@@ -364,7 +353,6 @@ def video_yingtu_parser(url):
     # https://app.yingtu.co/v1/interaction/topic/video/list  [post]
     # {"data":{"topicId":"861232236534439936","pageId":0},"userId":"1501646183777","source":"h5"}:
     def download_this(url):
-        import requests
         from urlparse import urlparse
         from urlparse import parse_qs
         a = urlparse(url)
@@ -375,7 +363,7 @@ def video_yingtu_parser(url):
         params = params % (tid, uid)
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         url_base = "https://app.yingtu.co/v1/interaction/topic/video/list"
-        resp = requests.post(url=url_base, data=params, headers=headers)
+        resp = http.get_session().post(url=url_base, data=params, headers=headers)
         return resp.json()
 
     def format_duration(d_text):
@@ -659,9 +647,8 @@ def video_pearvideo_parser(url):
 def video_shangyijiankang_parser(url):
     # http://api.sytown.cn/FrameWeb/FrameService/Api.ashx
     def download_this(url):
-        import requests
         params = '{"_dataid":"VideoIndexNewestList","_datatype":"json","_pageindex": 1, "_pagesize": 10, "_param": {}, "_type": "getlistpage"}'
-        resp = requests.post(url=url, data=params)
+        resp = http.get_session().post(url=url, data=params)
         return resp.json()
 
     def format_duration(d_text):
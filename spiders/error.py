@@ -32,3 +32,15 @@ class ImageDownloadError(ImageError):
 class ImageUploadError(ImageError):
 
     pass
+
+
+class HostUnavailableError(Error):
+    """ 域名熔断中, 请求直接失败 """
+
+    pass
+
+
+class PageMissingError(Error):
+    """ 详情页引用的页面内容在 COL_PAGES 中不存在 """
+
+    pass
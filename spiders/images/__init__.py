@@ -12,7 +12,7 @@ from PIL import Image
 import zbarlight
 
 from spiders.alioss import OnlineImageUploader
-from spiders.error import ImageDownloadError
+from spiders.error import ImageDownloadError, ImageUploadError
 from spiders.models import ImageMeta, FeedImageMeta
 from spiders.utilities import http
 
@@ -47,7 +47,10 @@ def upload_image(data, uploader):
     prefix = datetime.now().strftime("%Y%m%d%H%M%S")
     full_name = "%s%s_%sX%s.%s" % (prefix, name, w, h, suffix)
     headers = {"content-type": content_type}
-    url = uploader.upload(data=data, name=full_name, headers=headers)
+    try:
+        url = uploader.upload(data=data, name=full_name, headers=headers)
+    except Exception as e:
+        raise ImageUploadError(str(e))
     return url
 
 
@@ -2,8 +2,7 @@
 
 """html下载"""
 
-import requests
-from w3lib.encoding import html_to_unicode
+from spiders.utilities.http import decode_content, get_session
 
 __author__ = "Sven Lee"
 __copyright__ = "Copyright 2016-2019, ShangHai Lie Ying"
@@ -25,12 +24,10 @@ def download_page(url):
         "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
                       "(KHTML, like Gecko) Chrome/50.0.2661.86 Safari/537.36"
     }
-    response = requests.get(url, headers=headers)
+    response = get_session().get(url, headers=headers)
     if response.status_code == 200:
-        _, content = html_to_unicode(
-            content_type_header=response.headers.get("content-type"),
-            html_body_str=response.content
-        )
+        content = decode_content(response.content, response.headers.get("content-type"),
+                                 response.url)
         return content.encode("utf-8")
     else:
         return ""
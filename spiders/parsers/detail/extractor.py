@@ -417,14 +417,14 @@ class DuowanPhotoExtractor(AdjustExtractor):
         print "init"
         import re
         import json
-        import requests
+        from spiders.utilities.http import get_session
         id_re = r'galleryId = "(.*?)";'
         id = re.findall(id_re, self.origin)
         if id:
             id = id[0]
             detail_url = self.detail_url.format(id=id)
             try:
-                content = requests.get(detail_url).content
+                content = get_session().get(detail_url).content
                 self.data = json.loads(content)
             except:
                 self.data = dict()
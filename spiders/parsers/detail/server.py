@@ -431,6 +431,15 @@ class DefaultParser(object):
         result["support"] = flag
         return result
 
+    def supports(self, url):
+        """是否有与url匹配的解析配置,不下载页面
+        :param url:网址
+        :type url:str
+        :return:是否支持
+        :rtype:bool
+        """
+        return bool(Matcher.match(url, configs=self.cfgs, outers=self.ots))
+
 
 def main():
     import sys
@@ -1,21 +1,164 @@
 # coding: utf-8
 
+import logging
+import os
+from threading import Lock
 from urllib import quote
 
-from pymongo import MongoClient
-from redis import from_url
+from pymongo import MongoClient, monitoring
+from redis import BlockingConnectionPool, Redis
 
-from settings import MONGODB_HOST_PORT, MONGODB_PASSWORD
-from settings import REDIS_URL, REDIS_MAX_CONNECTIONS
+from settings import MONGODB_HOST_PORT, MONGODB_PASSWORD, MONGODB_POOL_OPTIONS
+from settings import REDIS_URL, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT
+
+_role = ["worker"]
+_overrides = dict()
+_clients = dict()  # (url, role) -> (pid, MongoClient, PoolStats)
+_clients_lock = Lock()
+
+
+class PoolStats(monitoring.CommandListener):
+    """ 统计一个 MongoClient 的命令数, 耗时和同时执行的命令数
+
+    pymongo 3.4 没有连接池事件, 无法直接得到等待连接的时间。命令在取得连接之后开始,
+    saturated 为开始时连接池已经全部占用的命令数, 此时之后的命令都需要等待空闲连接,
+    持续增长说明连接池成为瓶颈
+    """
+
+    def __init__(self, max_pool_size):
+        self.max_pool_size = max_pool_size
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """ 清空统计, inflight 除外 """
+        with self._lock:
+            self.inflight = getattr(self, "inflight", 0)
+            self.max_inflight = self.inflight
+            self.commands = 0
+            self.errors = 0
+            self.saturated = 0
+            self.duration = 0.0  # 秒
+
+    def started(self, event):
+        with self._lock:
+            self.inflight += 1
+            self.commands += 1
+            if self.inflight >= self.max_pool_size:
+                self.saturated += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+
+    def _finished(self, event, failed):
+        with self._lock:
+            self.inflight = max(0, self.inflight - 1)
+            self.duration += event.duration_micros / 1e6
+            if failed:
+                self.errors += 1
+
+    def succeeded(self, event):
+        self._finished(event, False)
+
+    def failed(self, event):
+        self._finished(event, True)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "max_pool_size": self.max_pool_size,
+                "inflight": self.inflight,
+                "max_inflight": self.max_inflight,
+                "commands": self.commands,
+                "errors": self.errors,
+                "saturated": self.saturated,
+                "avg_ms": self.duration * 1000 / self.commands if self.commands else 0,
+            }
+
+
+def set_mongodb_role(role, **options):
+    """ 设置当前进程的角色, 之后第一次访问数据库时按角色的参数创建 MongoClient
+
+    :param role: settings.MONGODB_POOL_OPTIONS 中的角色: worker, app, test
+    :type role: str
+    :param options: 覆盖角色默认的 MongoClient 参数, 如 maxPoolSize
+    """
+    if role not in MONGODB_POOL_OPTIONS:
+        raise ValueError("Unknown mongodb role: %s" % role)
+    _role[0] = role
+    _overrides.clear()
+    _overrides.update(options)
+
+
+def get_mongodb_client(url):
+    """ 获取当前进程, 当前角色共享的 MongoClient, fork 之后的子进程会重新创建 """
+    role = _role[0]
+    key = (url, role)
+    pid = os.getpid()
+    item = _clients.get(key)
+    if item is not None and item[0] == pid:
+        return item[1]
+    with _clients_lock:
+        item = _clients.get(key)
+        if item is None or item[0] != pid:
+            options = dict(MONGODB_POOL_OPTIONS[role])
+            options.update(_overrides)
+            stats = PoolStats(options["maxPoolSize"])
+            client = MongoClient(host=url, connect=False, event_listeners=[stats], **options)
+            item = (pid, client, stats)
+            _clients[key] = item
+            logging.info("Create mongodb client role: %s options: %s" % (role, options))
+        return item[1]
+
+
+def mongodb_pool_stats(reset=False):
+    """ 当前进程中各个 MongoClient 的统计
+
+    :param reset: 读取后清空统计
+    :type reset: bool
+    :rtype: dict
+    """
+    result = dict()
+    pid = os.getpid()
+    for (url, role), (_pid, client, stats) in _clients.items():
+        if _pid == pid:
+            result["%s@%s" % (role, url.rsplit("/", 1)[-1])] = stats.to_dict()
+            if reset:
+                stats.reset()
+    return result
+
+
+class LazyDatabase(object):
+    """ 延迟创建 MongoClient 的 Database 代理, 可以在模块导入时创建
+
+    每次访问时根据当前进程和角色取得 MongoClient, 因此 fork 之后或者 set_mongodb_role 之后
+    都会使用新的连接池
+    """
+
+    def __init__(self, url):
+        self._url = url
+
+    def _database(self):
+        return get_mongodb_client(self._url).get_default_database()
+
+    def __getitem__(self, name):
+        return self._database()[name]
+
+    def __getattr__(self, name):
+        return getattr(self._database(), name)
 
 
 def get_mongodb_database(database, user="third"):
     url = "mongodb://{0}:{1}@{2}/{3}".format(
         user, quote(MONGODB_PASSWORD), MONGODB_HOST_PORT, database
     )
-    client = MongoClient(host=url, maxPoolSize=1, minPoolSize=1)
-    return client.get_default_database()
+    return LazyDatabase(url)
 
 
 def get_cache_client(db):
-    return from_url(REDIS_URL, db=db, max_connections=REDIS_MAX_CONNECTIONS)
+    """ redis 客户端, 连接数达到 REDIS_MAX_CONNECTIONS 时等待其他线程释放连接, 而不是直接抛出异常
+
+    除了每个线程的任务, 空闲线程的 brpop, LeaseKeeper 的续租和限速, 去重, 缓存也会占用连接,
+    等待超过 REDIS_POOL_TIMEOUT 秒才抛出 ConnectionError(任务会重新入队)
+    """
+    pool = BlockingConnectionPool.from_url(REDIS_URL, db=db, max_connections=REDIS_MAX_CONNECTIONS,
+                                           timeout=REDIS_POOL_TIMEOUT)
+    return Redis(connection_pool=pool)
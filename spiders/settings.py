@@ -8,11 +8,29 @@ __date__ = "2017-05-15 16:57"
 REDIS_URL = "redis://内网IP:6379"
 # REDIS_URL = "redis://127.0.0.1:6379"
 REDIS_MAX_CONNECTIONS = 10
+REDIS_POOL_TIMEOUT = 20  # 连接全部被占用时等待的秒数
 
 MONGODB_HOST_PORT = "内网IP:27017"
 # MONGODB_HOST_PORT = "120.27.162.246:27017"
 MONGODB_PASSWORD = ""
+# 不同角色进程的 MongoClient 参数, 见 spiders.resource.set_mongodb_role
+MONGODB_POOL_OPTIONS = {
+    "worker": {"maxPoolSize": 16, "minPoolSize": 1, "waitQueueTimeoutMS": 30000,
+               "connectTimeoutMS": 10000, "socketTimeoutMS": 60000},
+    "app": {"maxPoolSize": 32, "minPoolSize": 2, "waitQueueTimeoutMS": 5000,
+            "connectTimeoutMS": 5000, "socketTimeoutMS": 30000},
+    "test": {"maxPoolSize": 4, "minPoolSize": 0, "waitQueueTimeoutMS": 5000,
+             "connectTimeoutMS": 5000, "socketTimeoutMS": 30000},
+}
 
+# 每个线程的 http 客户端同时进行的请求数和同一个域名的连接数, 见 spiders.utilities.http.configure
+HTTP_MAX_CLIENTS = 20
+HTTP_MAX_PER_HOST = 8
+# 所有抓取机器对同一个域名每秒的请求数, 瞬间最多的请求数, 同时进行的请求数,
+# spider_sites 的 limit 字段可以按网站覆盖, 见 spiders.business.sitelimits
+HTTP_HOST_RATE = 10
+HTTP_HOST_BURST = 20
+HTTP_HOST_INFLIGHT = 16
 
 OSS_BDP_IMAGES_ENDPOINT = ""
 OSS_BDP_IMAGES_DOMAIN = ""
@@ -8,7 +8,7 @@ import hashlib
 from HTMLParser import HTMLParser
 import re
 from urllib import urlencode
-from urlparse import urlparse, parse_qs, urlunparse
+from urlparse import urlparse, parse_qs, parse_qsl, urlunparse
 
 from bs4 import BeautifulSoup
 
@@ -92,6 +92,50 @@ def remove_url_query_params(url):
     return urlunparse(tuple(new))
 
 
+# 跟踪参数, 不影响页面内容
+TRACKING_PARAMS = {"spm", "scm", "from", "wfr", "share_token", "_ga"}
+TRACKING_PARAM_PREFIXES = ("utm_",)
+# 按域名归一化: 域名 -> (统一使用的域名, 保留的 query 参数, None 表示只去除跟踪参数)
+CANONICAL_SITE_RULES = {
+    "mp.weixin.qq.com": ("mp.weixin.qq.com", {"__biz", "mid", "idx", "sn"}),
+    "m.thepaper.cn": ("www.thepaper.cn", None),
+    "m.huxiu.com": ("www.huxiu.com", None),
+}
+
+
+def canonicalize_url(url):
+    """ 归一化 url, 用作 COL_REQUESTS 的 unique, 同一篇文章的不同 url 得到相同的结果
+
+    忽略 http/https, 域名大小写, 默认端口, fragment 和跟踪参数, query 参数按名称排序,
+    CANONICAL_SITE_RULES 中的域名使用统一的域名和参数。非 http(s) 的字符串原样返回。
+    只用于去重, 下载时仍使用原始 url
+
+    :type url: str
+    :rtype: str
+    """
+    url = url.strip()
+    is_unicode = isinstance(url, unicode)
+    result = urlparse(url.encode("utf-8") if is_unicode else url)
+    if result.scheme.lower() not in ("http", "https") or not result.hostname:
+        return url
+    host = result.hostname
+    if result.port and result.port not in (80, 443):
+        host = "%s:%s" % (host, result.port)
+    host, keep = CANONICAL_SITE_RULES.get(host, (host, None))
+    query = list()
+    for k, v in parse_qsl(result.query, keep_blank_values=True):
+        if keep is not None:
+            if k not in keep:
+                continue
+        elif k in TRACKING_PARAMS or k.startswith(TRACKING_PARAM_PREFIXES):
+            continue
+        query.append((k, v))
+    query.sort()
+    path = result.path or "/"
+    url = urlunparse(("http", host, path, result.params, urlencode(query), ""))
+    return url.decode("utf-8") if is_unicode else url
+
+
 def format_datetime_string(d):
     """ 归一化时间字符串 "%Y-%m-%d %H:%M:%S" or ""
     
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+""" 基于 redis bitmap 的 Bloom filter
+
+每个时间段(period)使用一个新的 bitmap, 查询时检查当前和上一个时间段的 bitmap,
+旧的 bitmap 自动过期, 因此占用的内存固定, 只记得最近一到两个时间段内添加的值。
+判断为不存在的值一定没有添加过(在记忆的时间段内), 判断为存在的值有 error_rate 的概率误判。
+"""
+
+import hashlib
+import math
+import struct
+import time
+
+
+class BloomFilter(object):
+
+    def __init__(self, client, key, capacity=5000000, error_rate=0.001, period=7 * 86400):
+        """
+        :param client: redis 客户端
+        :param key: bitmap key 前缀
+        :type key: str
+        :param capacity: 每个时间段预计添加的值的数量
+        :type capacity: int
+        :param error_rate: 达到 capacity 时的误判率
+        :type error_rate: float
+        :param period: 每个 bitmap 使用的秒数
+        :type period: int
+        """
+        self.client = client
+        self.key = key
+        self.period = period
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size * math.log(2) / capacity)))
+
+    def _keys(self):
+        generation = int(time.time() // self.period)
+        return ["%s:%s" % (self.key, generation), "%s:%s" % (self.key, generation - 1)]
+
+    def _offsets(self, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        h1, h2 = struct.unpack(">QQ", hashlib.md5(value).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add_many(self, values):
+        """ 将 values 添加到当前时间段的 bitmap """
+        if not values:
+            return
+        current = self._keys()[0]
+        pipe = self.client.pipeline(transaction=False)
+        for value in values:
+            for offset in self._offsets(value):
+                pipe.setbit(current, offset, 1)
+        pipe.expire(current, self.period * 2)
+        pipe.execute()
+
+    def add(self, value):
+        self.add_many([value])
+
+    def contains_many(self, values):
+        """ 判断 values 是否添加过
+
+        :rtype: list of bool
+        """
+        if not values:
+            return list()
+        keys = self._keys()
+        offsets = [self._offsets(value) for value in values]
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            for items in offsets:
+                for offset in items:
+                    pipe.getbit(key, offset)
+        bits = pipe.execute()
+        result = [False] * len(values)
+        n = self.hashes * len(values)
+        for k in range(len(keys)):
+            for i in range(len(values)):
+                start = k * n + i * self.hashes
+                if all(bits[start: start + self.hashes]):
+                    result[i] = True
+        return result
+
+    def __contains__(self, value):
+        return self.contains_many([value])[0]
@@ -0,0 +1,128 @@
+# coding: utf-8
+
+""" 按域名统计请求耗时和错误, 计算超时时间并熔断不可用的域名
+
+统计只在当前进程内进行:
+
+- 超时时间: 最近 SAMPLES 个成功和超时请求耗时的 p95 的若干倍, 限制在 [最小值, 默认值] 之内,
+  样本不足时使用默认值(10 秒连接, 30 秒请求)。超时的请求按其耗时(约为超时时间)计入样本,
+  超时较多的域名的超时时间会回到默认值; 最小值较大, 图片等大文件下载不会因为偶尔较慢而超时
+- 熔断: 连续失败 FAILURE_THRESHOLD 次, 或最近 WINDOW 个请求中失败占比不低于 ERROR_RATE 时打开,
+  之后 cooldown 秒内该域名的请求直接失败; 冷却结束后只放行一个探测请求,
+  成功则关闭, 失败则重新打开并加倍 cooldown(最长 MAX_COOLDOWN 秒)
+"""
+
+from collections import deque
+from threading import Lock
+import time
+
+CONNECT_TIMEOUT = 10.0  # 默认(最长)连接超时秒数
+REQUEST_TIMEOUT = 30.0  # 默认(最长)请求超时秒数
+MIN_CONNECT_TIMEOUT = 5.0
+MIN_REQUEST_TIMEOUT = 20.0
+CONNECT_FACTOR = 4  # 连接超时为 p95 的倍数
+REQUEST_FACTOR = 8  # 请求超时为 p95 的倍数
+SAMPLES = 100  # 计算耗时百分位的请求数
+MIN_SAMPLES = 10  # 少于该数量时使用默认超时
+WINDOW = 20  # 计算错误率的最近请求数
+ERROR_RATE = 0.5
+FAILURE_THRESHOLD = 5
+COOLDOWN = 30  # 熔断后第一次探测前的秒数
+MAX_COOLDOWN = 600
+
+
+class _Host(object):
+
+    def __init__(self):
+        self.latencies = deque(maxlen=SAMPLES)
+        self.outcomes = deque(maxlen=WINDOW)  # True 为成功
+        self.failures = 0  # 连续失败次数
+        self.opened = None  # 熔断打开的时间, None 表示关闭
+        self.cooldown = COOLDOWN
+        self.probing = None  # 冷却结束后放行探测请求的时间
+
+
+class HostHealth(object):
+
+    def __init__(self):
+        self._hosts = dict()
+        self._lock = Lock()
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts.setdefault(host, _Host())
+        return state
+
+    def timeouts(self, host):
+        """ 域名的 (连接超时, 请求超时) 秒数 """
+        with self._lock:
+            latencies = sorted(self._host(host).latencies) if host else list()
+        if len(latencies) < MIN_SAMPLES:
+            return CONNECT_TIMEOUT, REQUEST_TIMEOUT
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        connect = min(CONNECT_TIMEOUT, max(MIN_CONNECT_TIMEOUT, p95 * CONNECT_FACTOR))
+        request = min(REQUEST_TIMEOUT, max(MIN_REQUEST_TIMEOUT, p95 * REQUEST_FACTOR))
+        return connect, request
+
+    def allow(self, host):
+        """ 是否可以请求该域名, 熔断冷却结束后只放行一个探测请求 """
+        if not host:
+            return True
+        with self._lock:
+            state = self._host(host)
+            if state.opened is None:
+                return True
+            now = time.time()
+            if now - state.opened < state.cooldown:
+                return False
+            # 探测请求没有结果(如进程内异常)时, 超过最长请求时间后再放行一个
+            if state.probing and now - state.probing < CONNECT_TIMEOUT + REQUEST_TIMEOUT:
+                return False
+            state.probing = now
+            return True
+
+    def record(self, host, latency, ok, timed_out=False):
+        """ 记录一个请求的结果
+
+        :param latency: 请求耗时秒数
+        :type latency: float
+        :param ok: 是否成功, 超时, 连接失败和 5xx 为失败, 4xx 等说明域名可用, 视为成功
+        :type ok: bool
+        :param timed_out: 是否超时, 超时的请求同样计入耗时样本, 避免只统计较快的请求
+        :type timed_out: bool
+        """
+        if not host:
+            return
+        with self._lock:
+            state = self._host(host)
+            state.outcomes.append(ok)
+            if ok or timed_out:
+                state.latencies.append(latency)
+            if ok:
+                state.failures = 0
+                state.opened = None
+                state.cooldown = COOLDOWN
+                state.probing = None
+                return
+            state.failures += 1
+            if state.probing:  # 探测失败, 重新打开
+                state.opened = time.time()
+                state.cooldown = min(MAX_COOLDOWN, state.cooldown * 2)
+                state.probing = None
+            elif state.opened is None and self._should_open(state):
+                state.opened = time.time()
+
+    @staticmethod
+    def _should_open(state):
+        if state.failures >= FAILURE_THRESHOLD:
+            return True
+        outcomes = state.outcomes
+        return len(outcomes) >= WINDOW and outcomes.count(False) >= len(outcomes) * ERROR_RATE
+
+    def stats(self):
+        """ 熔断中的域名 -> 剩余冷却秒数 """
+        now = time.time()
+        with self._lock:
+            return {host: max(0, int(state.opened + state.cooldown - now))
+                    for host, state in self._hosts.items() if state.opened is not None}
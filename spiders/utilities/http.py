@@ -2,18 +2,30 @@
 
 """ http 相关工具函数 """
 
+import codecs
+from contextlib import contextmanager
+from cookielib import DefaultCookiePolicy
 from functools import partial
 import json
+import os
 import random
+import threading
+import time
+from urlparse import urlparse
 
 import chardet
 import requests
+from requests.adapters import HTTPAdapter
 from tornado.httpclient import HTTPClient
 from tornado.httpclient import AsyncHTTPClient
-from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.httpclient import HTTPError, HTTPRequest, HTTPResponse
 from tornado import gen
 from tornado.ioloop import IOLoop
-from w3lib.encoding import html_to_unicode
+from tornado.locks import Semaphore
+from w3lib.encoding import html_to_unicode, http_content_type_encoding
+
+from spiders.error import HostUnavailableError
+from spiders.utilities.hosthealth import HostHealth
 
 
 WebBrowser = [
@@ -106,7 +118,199 @@ MobileBrowser = [
 MobileDefault = MobileBrowser[0]
 
 
-AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
+MAX_CLIENTS = 20  # 每个 http 客户端同时进行的请求数
+MAX_PER_HOST = 8  # 同一个域名同时进行的请求数(连接数)
+_local = threading.local()  # 每个线程(进程)长期使用的 http 客户端
+_limiter = [None]  # 按域名限速, 见 set_limiter
+LIMIT_TIMEOUT = 300  # 等待限速许可的最长秒数, 超过后不再等待
+health = HostHealth()  # 按域名的超时时间和熔断状态
+
+
+def configure(max_clients=MAX_CLIENTS, max_per_host=MAX_PER_HOST):
+    """ 设置 http 客户端的并发数, 需要在第一次下载之前调用 """
+    global MAX_CLIENTS, MAX_PER_HOST
+    MAX_CLIENTS, MAX_PER_HOST = max_clients, max_per_host
+    AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient",
+                              max_clients=max_clients)
+
+
+configure()
+
+
+def _thread_local(name, factory):
+    """ 当前线程的 name 对象, fork 之后的子进程重新创建, 不与父进程共享连接 """
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        _local.__dict__.clear()
+        _local.pid = pid
+    value = getattr(_local, name, None)
+    if value is None:
+        value = factory()
+        setattr(_local, name, value)
+    return value
+
+
+def get_http_client():
+    """ 当前线程的 tornado HTTPClient, 复用 curl 的连接和 DNS 缓存 """
+    return _thread_local("http_client", HTTPClient)
+
+
+def set_limiter(limiter):
+    """ 设置所有下载共用的限速器, None 表示不限速
+
+    限速器需要提供 try_acquire(url) -> (token, 等待秒数), acquire(url, timeout) -> token,
+    release(url, token), 见 spiders.utilities.ratelimit.HostLimiter
+    """
+    _limiter[0] = limiter
+
+
+@contextmanager
+def limited(url):
+    """ 在限速器允许后执行请求, 结束后释放许可 """
+    limiter = _limiter[0]
+    if limiter is None:
+        yield
+        return
+    token = limiter.acquire(url, timeout=LIMIT_TIMEOUT)
+    try:
+        yield
+    finally:
+        limiter.release(url, token)
+
+
+def _check_host(url):
+    """ 域名熔断中时直接失败
+
+    :return: 域名
+    :rtype: str
+    """
+    host = urlparse(url).hostname
+    if not health.allow(host):
+        raise HostUnavailableError("Host unavailable: %s" % host)
+    return host
+
+
+def _is_host_error(code):
+    """ 超时, 连接失败(599)和服务端错误说明域名不可用 """
+    return code == 599 or code >= 500
+
+
+def _is_timeout(error):
+    """ tornado 599 错误是否为超时(curl 错误码 28, simple 客户端为 Timeout) """
+    if error is None:
+        return False
+    message = str(error).lower()
+    return getattr(error, "errno", None) == 28 or "timeout" in message or "timed out" in message
+
+
+class LimitedSession(requests.Session):
+    """ 每个请求都检查域名熔断状态, 等待限速器许可, 未指定 timeout 时使用域名的超时时间 """
+
+    def request(self, method, url, *args, **kwargs):
+        host = _check_host(url)
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = health.timeouts(host)
+        with limited(url):
+            start = time.time()
+            try:
+                r = super(LimitedSession, self).request(method, url, *args, **kwargs)
+            except requests.Timeout:
+                health.record(host, time.time() - start, False, timed_out=True)
+                raise
+            except requests.ConnectionError:
+                health.record(host, time.time() - start, False)
+                raise
+            health.record(host, time.time() - start, not _is_host_error(r.status_code))
+            return r
+
+
+def _new_session():
+    session = LimitedSession()
+    # 线程内所有网站共用一个 session, 不保存响应设置的 cookie, 需要 cookie 时通过 cookies 参数传入
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=MAX_CLIENTS, pool_maxsize=MAX_PER_HOST)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """ 当前线程的 requests.Session, 复用 keep-alive 连接 """
+    return _thread_local("session", _new_session)
+
+
+DETECT_SIZE = 16 * 1024  # chardet 只检测响应内容的前 DETECT_SIZE 字节
+MAX_MEMO_HOSTS = 10000
+_host_encodings = dict()  # 域名 -> 上次检测出的编码(响应头和 <meta> 都没有声明编码时使用)
+MULTIBYTE_ENCODINGS = {"gb2312", "gbk", "gb18030", "hz", "big5", "big5hkscs", "cp950", "euc_jp",
+                       "shift_jis", "cp932", "iso2022_jp", "euc_kr", "cp949", "iso2022_kr",
+                       "utf-8", "utf-8-sig", "utf-16", "utf-32"}  # codecs.lookup 之后的名称
+
+
+def _can_decode(body, encoding):
+    try:
+        body.decode(encoding)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+
+def _is_multibyte(encoding):
+    """ 是否为多字节编码, ascii 和单字节编码(iso-8859-*, windows-125* 等)几乎可以解码任何内容, 不可靠 """
+    try:
+        return codecs.lookup(encoding).name in MULTIBYTE_ENCODINGS
+    except LookupError:
+        return False
+
+
+def _detect_encoding(body, host):
+    """ 响应头, BOM 和 <meta> 都没有声明编码时检测编码
+
+    依次尝试 utf-8, 该域名上次检测出的编码, chardet 检测前 DETECT_SIZE 字节;
+    前 DETECT_SIZE 字节检测出 ascii 或单字节编码时(如中文内容在 16KB 之后)检测全部内容。
+    只记忆能解码全部内容的多字节编码。
+    """
+    if _can_decode(body, "utf-8"):
+        return "utf-8"
+    encoding = _host_encodings.get(host)
+    if encoding and _can_decode(body, encoding):
+        return encoding
+    encoding = chardet.detect(body[:DETECT_SIZE]).get("encoding")
+    if (not encoding or not _is_multibyte(encoding)) and len(body) > DETECT_SIZE:
+        encoding = chardet.detect(body).get("encoding")
+    if encoding and host and _is_multibyte(encoding) and _can_decode(body, encoding):
+        if len(_host_encodings) >= MAX_MEMO_HOSTS:
+            _host_encodings.clear()
+        _host_encodings[host] = encoding
+    return encoding
+
+
+def decode_content(body, content_type=None, url=None):
+    """ 将响应内容解码为 unicode
+
+    JSON 响应直接按响应头声明的编码(默认 utf-8)解码, 不检测编码;
+    其他响应依次使用 BOM, 响应头的 charset, 前 4KB 中 <meta> 声明的编码(w3lib html_to_unicode),
+    都没有时由 _detect_encoding 检测。
+
+    :param body: 响应内容
+    :type body: str
+    :param content_type: 响应头的 Content-Type
+    :type content_type: str
+    :param url: 响应的链接, 用于按域名记忆检测出的编码
+    :type url: str
+    :rtype: unicode
+    """
+    body = body or ""
+    if content_type and "json" in content_type.lower():
+        encoding = http_content_type_encoding(content_type) or "utf-8"
+        return body.decode(encoding, "replace")
+    host = urlparse(url).hostname if url else None
+    _, content = html_to_unicode(
+        content_type_header=content_type,
+        html_body_str=body,
+        auto_detect_fun=lambda x: _detect_encoding(x, host)
+    )
+    return content
 
 
 def get_random_browser():
@@ -127,12 +331,8 @@ def get_default_mobile():
 
 def stable_download_content(url):
     headers = {"user-agent": get_random_browser()}
-    r = requests.get(url, headers=headers, timeout=(10, 30))
-    _, content = html_to_unicode(
-        content_type_header=r.headers.get("Content-Type"),
-        html_body_str=r.content,
-        auto_detect_fun=lambda x: chardet.detect(x).get("encoding")
-    )
+    r = get_session().get(url, headers=headers)
+    content = decode_content(r.content, r.headers.get("Content-Type"), r.url)
     return r.url, content
 
 
@@ -154,16 +354,13 @@ class RequestsDownloader(Downloader):
         method = req.method
         assert method in {"GET", "POST"}
         timeout = (req.connect_timeout, req.request_timeout)
+        session = get_session()
         if method == "GET":
-            r = requests.get(url=url, headers=headers, timeout=timeout)
+            r = session.get(url=url, headers=headers, timeout=timeout)
         else:
-            r = requests.post(url=url, data=req.body, headers=headers,
-                              timeout=timeout)
-        _, content = html_to_unicode(
-            content_type_header=r.headers.get("Content-Type"),
-            html_body_str=r.content,
-            auto_detect_fun=lambda x: chardet.detect(x).get("encoding")
-        )
+            r = session.post(url=url, data=req.body, headers=headers,
+                             timeout=timeout)
+        content = decode_content(r.content, r.headers.get("Content-Type"), r.url)
         return r.url, content
 
 
@@ -171,8 +368,10 @@ class Request(HTTPRequest):
 
     def __init__(self, url, **kwargs):
         kwargs["user_agent"] = kwargs.get("user_agent", WebDefault)
-        kwargs["connect_timeout"] = kwargs.get("connect_timeout", 10.0)
-        kwargs["request_timeout"] = kwargs.get("request_timeout", 30.0)
+        if kwargs.get("connect_timeout") is None or kwargs.get("request_timeout") is None:
+            connect_timeout, request_timeout = health.timeouts(urlparse(url).hostname)
+            kwargs["connect_timeout"] = kwargs.get("connect_timeout") or connect_timeout
+            kwargs["request_timeout"] = kwargs.get("request_timeout") or request_timeout
         super(Request, self).__init__(url, **kwargs)
 
     @classmethod
@@ -197,7 +396,19 @@ def download(request=None, url=None):
     assert request or url
     if not request and url:
         request = Request(url=url)
-    response = HTTPClient().fetch(request)
+    host = _check_host(request.url)
+    with limited(request.url):
+        start = time.time()
+        try:
+            response = get_http_client().fetch(request)
+        except HTTPError as e:
+            timed_out = e.code == 599 and _is_timeout(e)
+            health.record(host, time.time() - start, not _is_host_error(e.code), timed_out)
+            raise
+        except Exception:
+            health.record(host, time.time() - start, False)
+            raise
+    health.record(host, time.time() - start, True)
     return response
 
 
@@ -218,22 +429,57 @@ def download_html(request=None, url=None):
 def response_url_content(response):
     """ 通过 tornado HTTPResponse 返回有效的链接和unicode的内容"""
     assert isinstance(response, HTTPResponse)
-    _, content = html_to_unicode(
-        content_type_header=response.headers.get("Content-Type"),
-        html_body_str=response.body,
-        auto_detect_fun=lambda x: chardet.detect(x).get("encoding")
-    )
+    content = decode_content(response.body, response.headers.get("Content-Type"),
+                             response.effective_url)
     return response.effective_url, content
 
 
 @gen.coroutine
-def _run(requests):
-    results = yield [AsyncHTTPClient().fetch(request, raise_error=False) for
-                     request in requests]
+def _acquire_async(limiter, url):
+    """ 不阻塞 IOLoop 地等待限速许可 """
+    waited = 0
+    while True:
+        token, wait = limiter.try_acquire(url)
+        if not wait:
+            raise gen.Return(token)
+        if waited + wait > LIMIT_TIMEOUT:
+            raise gen.Return(None)
+        waited += wait
+        yield gen.sleep(wait)
+
+
+@gen.coroutine
+def _run(requests, concurrency=None):
+    semaphores = dict()  # 域名 -> Semaphore, 限制同一个域名同时进行的请求数
+    total = Semaphore(concurrency or len(requests) or 1)  # 限制所有请求同时进行的数量
+
+    @gen.coroutine
+    def fetch(request):
+        host = urlparse(request.url).hostname
+        if host not in semaphores:
+            semaphores[host] = Semaphore(MAX_PER_HOST)
+        with (yield semaphores[host].acquire()), (yield total.acquire()):
+            if not health.allow(host):  # 等待期间可能已经熔断
+                error = HostUnavailableError("Host unavailable: %s" % host)
+                raise gen.Return(HTTPResponse(request, 599, error=error, request_time=0))
+            limiter, token = _limiter[0], None
+            if limiter is not None:
+                token = yield _acquire_async(limiter, request.url)
+            try:
+                response = yield AsyncHTTPClient().fetch(request, raise_error=False)
+                timed_out = response.code == 599 and _is_timeout(response.error)
+                health.record(host, response.request_time or 0, not _is_host_error(response.code),
+                              timed_out)
+            finally:
+                if limiter is not None:
+                    limiter.release(request.url, token)
+        raise gen.Return(response)
+
+    results = yield [fetch(request) for request in requests]
     raise gen.Return(results)
 
 
-def multidownload(urls=None, requests=None, refer=None):
+def multidownload(urls=None, requests=None, refer=None, concurrency=None):
     """ 多链接下载器
     
     Notes: 根据请求返回多个响应
@@ -244,7 +490,9 @@ def multidownload(urls=None, requests=None, refer=None):
     :type requests: iterable of Request
     :param refer: referer
     :type refer: string or None
-    :return: http 响应
+    :param concurrency: 同时进行的请求数, None 时只受 MAX_CLIENTS, MAX_PER_HOST 限制
+    :type concurrency: int or None
+    :return: http 响应, 与请求的顺序相同
     :rtype: list of tornado.httpclient.HTTPResponse
     """
     single = False
@@ -257,5 +505,5 @@ def multidownload(urls=None, requests=None, refer=None):
     elif isinstance(requests, Request):
         single = True
         requests = [requests]
-    responses = IOLoop.current().run_sync(partial(_run, requests))
+    responses = IOLoop.current().run_sync(partial(_run, requests, concurrency))
     return responses[0] if single else responses
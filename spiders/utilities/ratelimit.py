@@ -0,0 +1,125 @@
+# coding: utf-8
+
+""" 基于 redis 的按域名限速, 多台机器的所有进程共享同一个限制
+
+每个域名两个 key:
+
+- ``<prefix>:<host>:tokens`` hash, 令牌桶剩余的令牌数和上次更新时间, 每秒补充 rate 个, 最多 burst 个
+- ``<prefix>:<host>:inflight`` sorted set, 正在进行的请求及其租约到期时间, 最多 inflight 个,
+  进程被杀死没有 release 的请求在租约到期后自动释放
+
+rate, burst, inflight 为 0 时不做对应的限制。各机器的时间需要同步(ntp)。
+"""
+
+import logging
+import time
+from urlparse import urlparse
+import uuid
+
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local inflight = tonumber(ARGV[4])
+local lease = tonumber(ARGV[6])
+if inflight > 0 then
+    redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", now)
+    if redis.call("ZCARD", KEYS[2]) >= inflight then
+        return -1
+    end
+end
+if rate > 0 then
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "time")
+    local tokens = tonumber(bucket[1]) or burst
+    local last = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+    if tokens < 1 then
+        return math.ceil((1 - tokens) / rate * 1000)
+    end
+    redis.call("HMSET", KEYS[1], "tokens", tostring(tokens - 1), "time", ARGV[1])
+    redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 60)
+end
+if inflight > 0 then
+    redis.call("ZADD", KEYS[2], now + lease, ARGV[5])
+    redis.call("EXPIRE", KEYS[2], lease + 60)
+end
+return 0
+"""
+INFLIGHT_WAIT = 0.05  # 同时进行的请求数达到上限时等待的秒数
+
+
+class HostLimiter(object):
+
+    def __init__(self, client, prefix, rate=10.0, burst=20, inflight=16, lease=120,
+                 overrides=None):
+        """
+        :param client: redis 客户端
+        :param prefix: key 前缀
+        :type prefix: str
+        :param rate: 每个域名每秒的请求数
+        :type rate: float
+        :param burst: 每个域名瞬间最多的请求数
+        :type burst: int
+        :param inflight: 每个域名同时进行的请求数
+        :type inflight: int
+        :param lease: 请求的租约秒数, 应大于请求的超时时间
+        :type lease: int
+        :param overrides: 域名 -> {"rate": rate, "burst": burst, "inflight": inflight} 或 None
+        :type overrides: callable
+        """
+        self.client = client
+        self.prefix = prefix
+        self.rate = rate
+        self.burst = burst
+        self.inflight = inflight
+        self.lease = lease
+        self.overrides = overrides
+        self._acquire = client.register_script(ACQUIRE_SCRIPT)
+
+    def limits(self, host):
+        """ 域名的 (rate, burst, inflight) """
+        limit = self.overrides(host) if self.overrides else None
+        limit = limit or dict()
+        return (float(limit.get("rate", self.rate)), int(limit.get("burst", self.burst)),
+                int(limit.get("inflight", self.inflight)))
+
+    def try_acquire(self, url):
+        """ 尝试为 url 获取一个请求许可
+
+        :return: (token, 需要等待的秒数), 等待秒数为 0 时获取成功, token 用于 release
+        :rtype: (str, float)
+        """
+        host = urlparse(url).hostname
+        if not host:
+            return None, 0
+        rate, burst, inflight = self.limits(host)
+        if not rate and not inflight:
+            return None, 0
+        token = uuid.uuid4().hex
+        keys = ["%s:%s:tokens" % (self.prefix, host), "%s:%s:inflight" % (self.prefix, host)]
+        args = ["%.3f" % time.time(), rate, max(burst, 1), inflight, token, self.lease]
+        wait = self._acquire(keys=keys, args=args)
+        if wait == 0:
+            return token, 0
+        return None, INFLIGHT_WAIT if wait < 0 else wait / 1000.0
+
+    def acquire(self, url, timeout=None):
+        """ 阻塞直到获取请求许可, 超过 timeout 秒时不再等待(返回 None)
+
+        :rtype: str
+        """
+        start = time.time()
+        while True:
+            token, wait = self.try_acquire(url)
+            if not wait:
+                return token
+            if timeout is not None and time.time() - start + wait > timeout:
+                logging.warning("Rate limit wait timeout: %s" % url)
+                return None
+            time.sleep(wait)
+
+    def release(self, url, token):
+        """ 请求结束后释放许可 """
+        if token:
+            host = urlparse(url).hostname
+            self.client.zrem("%s:%s:inflight" % (self.prefix, host), token)
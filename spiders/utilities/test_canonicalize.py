@@ -0,0 +1,57 @@
+# coding: utf-8
+
+"""
+canonicalize_url 测试
+
+    python -m unittest spiders.utilities.test_canonicalize
+"""
+
+import unittest
+
+from spiders.utilities import canonicalize_url
+
+
+class CanonicalizeUrlTest(unittest.TestCase):
+
+    def test_scheme_host_port_fragment(self):
+        self.assertEqual(canonicalize_url("https://WWW.Example.com:443/a?b=1#top"),
+                         "http://www.example.com/a?b=1")
+        self.assertEqual(canonicalize_url("http://www.example.com:80"), "http://www.example.com/")
+        self.assertEqual(canonicalize_url("http://www.example.com:8080/a"),
+                         "http://www.example.com:8080/a")
+
+    def test_tracking_params_and_order(self):
+        url = "http://news.example.com/a.html?utm_source=wx&id=2&spm=a.b&from=timeline&cid=1"
+        self.assertEqual(canonicalize_url(url), "http://news.example.com/a.html?cid=1&id=2")
+        self.assertEqual(canonicalize_url("http://news.example.com/a.html?b=&a=1"),
+                         "http://news.example.com/a.html?a=1&b=")
+
+    def test_weixin(self):
+        url = ("https://mp.weixin.qq.com/s?__biz=MzA3&mid=2650&idx=1&sn=abc"
+               "&chksm=8456&scene=21&key=xyz#wechat_redirect")
+        expected = "http://mp.weixin.qq.com/s?__biz=MzA3&idx=1&mid=2650&sn=abc"
+        self.assertEqual(canonicalize_url(url), expected)
+        same = "http://mp.weixin.qq.com/s?sn=abc&idx=1&mid=2650&__biz=MzA3&chksm=0000"
+        self.assertEqual(canonicalize_url(same), expected)
+
+    def test_mobile_hosts(self):
+        self.assertEqual(canonicalize_url("https://m.thepaper.cn/newsDetail_forward_1"),
+                         canonicalize_url("http://www.thepaper.cn/newsDetail_forward_1"))
+        self.assertEqual(canonicalize_url("https://m.huxiu.com/article/2.html?f=share"),
+                         "http://www.huxiu.com/article/2.html?f=share")
+
+    def test_unicode(self):
+        result = canonicalize_url(u"http://www.example.com/新闻?q=中文&utm_medium=x")
+        self.assertIsInstance(result, unicode)
+        self.assertEqual(result, u"http://www.example.com/新闻?q=%E4%B8%AD%E6%96%87")
+
+    def test_non_url_unique(self):
+        md5 = "d41d8cd98f00b204e9800998ecf8427e"
+        self.assertEqual(canonicalize_url(md5), md5)
+        self.assertEqual(canonicalize_url(u"weibo:4123456789"), u"weibo:4123456789")
+        self.assertEqual(canonicalize_url("ftp://example.com/a"), "ftp://example.com/a")
+        self.assertEqual(canonicalize_url("  http://example.com/a  "), "http://example.com/a")
+
+
+if __name__ == "__main__":
+    unittest.main()
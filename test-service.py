@@ -17,6 +17,7 @@ from spiders.utilities import http
 from spiders.parsers import PageParser, DetailParser, FeedParser
 from spiders.business.utils import db_third_party as db
 from spiders.business.utils import COL_CONFIGS, COL_CHANNELS, COL_ADVERTISEMENT
+from spiders.resource import set_mongodb_role
 
 
 class ListParseHandler(RequestHandler):
@@ -96,6 +97,7 @@ def config_logging(suffix=""):
 
 def main():
     config_logging("test")
+    set_mongodb_role("test")
     app = tornado.web.Application([
         (r"/test/parse/list", ListParseHandler),
         (r"/test/parse/page", PageParseHandler),